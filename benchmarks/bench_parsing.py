@@ -0,0 +1,183 @@
+"""
+Benchmark decoding and formatting of searchanalytics responses.
+
+Compares the previous per-row implementations (a dict per row, iterrows and
+per-cell lambdas, joining periods on string indexes) with the columnar
+decoder, column-at-a-time formatting and joins on integer codes in server.py,
+on synthetic responses of 1k, 25k and 250k rows.
+
+Usage:
+    python benchmarks/bench_parsing.py [--repeat N]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import server  # noqa: E402
+
+SIZES = [1000, 25000, 250000]
+DIMENSIONS = ['query', 'page', 'country', 'device']
+
+
+def make_rows(n, seed=0):
+    """Build a deterministic rows payload shaped like the API's"""
+    rng = random.Random(seed)
+    devices = ['DESKTOP', 'MOBILE', 'TABLET']
+    countries = ['usa', 'gbr', 'deu', 'fra', 'ind', 'bra']
+    rows = []
+    for i in range(n):
+        impressions = rng.randint(1, 10000)
+        clicks = rng.randint(0, impressions // 3)
+        rows.append({
+            'keys': [
+                f'example query {i % (n // 4 + 1)}',
+                f'https://www.example.com/section-{i % 50}/page-{i}',
+                rng.choice(countries),
+                rng.choice(devices),
+            ],
+            'clicks': clicks,
+            'impressions': impressions,
+            'ctr': clicks / impressions,
+            'position': rng.uniform(1, 80),
+        })
+    return rows
+
+
+def legacy_response_to_dataframe(response, dimensions):
+    """The previous _response_to_dataframe: one dict per row"""
+    data = []
+    for row in response['rows']:
+        row_data = {}
+        for i, dim in enumerate(dimensions):
+            row_data[dim] = row['keys'][i] if i < len(row.get('keys', [])) else None
+        row_data['clicks'] = row.get('clicks', 0)
+        row_data['impressions'] = row.get('impressions', 0)
+        row_data['ctr'] = row.get('ctr', 0)
+        row_data['position'] = row.get('position', 0)
+        data.append(row_data)
+    return pd.DataFrame(data)
+
+
+def legacy_format_table(rows, dimensions):
+    """The previous query_search_analytics formatting: string concatenation per row"""
+    result = []
+    for row in rows:
+        row_data = list(row.get('keys', []))
+        row_data.append(str(row.get('clicks', 0)))
+        row_data.append(str(row.get('impressions', 0)))
+        row_data.append(f"{row.get('ctr', 0) * 100:.2f}%")
+        row_data.append(f"{row.get('position', 0):.2f}")
+        result.append(" | ".join(row_data))
+    return result
+
+
+def legacy_format_cells(df):
+    """The previous compare_time_periods formatting: a lambda per cell"""
+    df = df.copy()
+    df['ctr'] = df['ctr'].apply(lambda x: f"{x*100:.2f}%")
+    df['position'] = df['position'].apply(lambda x: f"{x:.2f}")
+    return df
+
+
+def legacy_format_trends(df):
+    """The previous get_search_trends formatting: iterrows"""
+    result = []
+    for _, row in df.iterrows():
+        result.append(f"{row['date']:<12} | {row['clicks']:<10.0f} | {row['impressions']:<12.0f} | "
+                      f"{row['ctr'] * 100:<8.2f}% | {row['position']:<8.2f}")
+    return result
+
+
+def legacy_merge_periods(period_dfs, dimensions):
+    """The previous compare_time_periods join: an outer concat on string MultiIndexes"""
+    indexed_dfs = []
+    for label, df in period_dfs.items():
+        df = df.set_index(dimensions)[['clicks', 'impressions', 'ctr', 'position']]
+        indexed_dfs.append(df.add_suffix(f'_{label}'))
+    return pd.concat(indexed_dfs, axis=1, join='outer').reset_index()
+
+
+def new_format_table(df, dimensions):
+    columns = [server._format_text(df[dim]) for dim in dimensions]
+    columns.append(server._format_column(df['clicks'], '{:.0f}'))
+    columns.append(server._format_column(df['impressions'], '{:.0f}'))
+    columns.append(server._format_column(df['ctr'] * 100, '{:.2f}%'))
+    columns.append(server._format_column(df['position'], '{:.2f}'))
+    return server._join_columns(columns)
+
+
+def new_format_cells(df):
+    df = df.copy()
+    df['ctr'] = server._format_column(df['ctr'] * 100, "{:.2f}%")
+    df['position'] = server._format_column(df['position'], "{:.2f}")
+    return df
+
+
+def new_format_trends(df):
+    return server._join_columns([
+        server._format_text(df['date']),
+        server._format_column(df['clicks'], '{:<10.0f}'),
+        server._format_column(df['impressions'], '{:<12.0f}'),
+        server._format_column(df['ctr'] * 100, '{:<8.2f}%'),
+        server._format_column(df['position'], '{:<8.2f}'),
+    ])
+
+
+def best_of(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=3, help='runs per measurement (best is reported)')
+    args = parser.parse_args()
+
+    print(f"{'Stage':<28} | {'Rows':>7} | {'Before (ms)':>11} | {'After (ms)':>10} | {'Speedup':>7}")
+    print("-" * 75)
+
+    for n in SIZES:
+        rows = make_rows(n)
+        response = {'rows': rows}
+        legacy_df = legacy_response_to_dataframe(response, DIMENSIONS)
+        new_df = server._response_to_dataframe(response, DIMENSIONS)
+        # Periods overlap by half their rows, like a site's queries from one month to the next
+        periods = {
+            'current': new_df.drop_duplicates(DIMENSIONS),
+            'previous': server._response_to_dataframe({'rows': rows[n // 2:] + make_rows(n // 2, seed=1)},
+                                                      DIMENSIONS).drop_duplicates(DIMENSIONS),
+        }
+        trends_df = legacy_df.rename(columns={'query': 'date'})
+        new_trends_df = new_df.rename(columns={'query': 'date'})
+
+        stages = [
+            ('decode rows', lambda: legacy_response_to_dataframe(response, DIMENSIONS),
+             lambda: server._response_to_dataframe(response, DIMENSIONS)),
+            ('format table', lambda: legacy_format_table(rows, DIMENSIONS),
+             lambda: new_format_table(new_df, DIMENSIONS)),
+            ('format cells (compare)', lambda: legacy_format_cells(legacy_df),
+             lambda: new_format_cells(new_df)),
+            ('format rows (trends)', lambda: legacy_format_trends(trends_df),
+             lambda: new_format_trends(new_trends_df)),
+            ('merge periods (compare)', lambda: legacy_merge_periods(periods, DIMENSIONS),
+             lambda: server._merge_periods(periods, DIMENSIONS)),
+        ]
+        for name, before, after in stages:
+            before_time = best_of(before, args.repeat)
+            after_time = best_of(after, args.repeat)
+            print(f"{name:<28} | {n:>7} | {before_time * 1000:>11.1f} | {after_time * 1000:>10.1f} | "
+                  f"{before_time / after_time:>6.1f}x")
+
+
+if __name__ == '__main__':
+    main()
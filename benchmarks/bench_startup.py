@@ -0,0 +1,170 @@
+"""
+Benchmark how quickly a new stdio server process becomes useful.
+
+Starts benchmarks/fake_gsc.py in this process, then launches server.py the
+way MCP clients do, as a fresh stdio process, and measures the time from
+launch to the initialize response, to the first list_sites result and to
+the first query_search_analytics result (the first call that needs pandas).
+Results are written as sorted, indented JSON, so they can be tracked across
+versions and compared with --compare.
+
+Usage:
+    python benchmarks/bench_startup.py [--repeat N] [--output FILE] [--compare BASELINE] [--threshold FRACTION]
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER = os.path.join(BENCHMARKS_DIR, '..', 'server.py')
+sys.path.insert(0, BENCHMARKS_DIR)
+
+import fake_gsc  # noqa: E402
+from bench_tools import _git_revision  # noqa: E402
+
+# Requests sent after initialize, and the name their timing is reported under
+FIRST_CALLS = [
+    ('first_tool_ms', 'list_sites', {}),
+    ('first_query_ms', 'query_search_analytics', {
+        'site_url': 'https://www.example.com/', 'start_date': '2024-01-01', 'end_date': '2024-01-28',
+        'dimensions': ['query'], 'row_limit': 1000}),
+]
+
+
+class _StdioSession:
+    """A server process spoken to with newline-delimited JSON-RPC, like an MCP client"""
+
+    def __init__(self, env):
+        self.process = subprocess.Popen(
+            [sys.executable, SERVER], env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, text=True, bufsize=1)
+        self._next_id = 1
+
+    def send(self, method, params=None, notification=False):
+        message = {'jsonrpc': '2.0', 'method': method}
+        if params is not None:
+            message['params'] = params
+        if not notification:
+            message['id'] = self._next_id
+            self._next_id += 1
+        self.process.stdin.write(json.dumps(message) + '\n')
+        self.process.stdin.flush()
+        return message.get('id')
+
+    def request(self, method, params=None):
+        """Send a request and return its response, skipping notifications"""
+        request_id = self.send(method, params)
+        for line in self.process.stdout:
+            message = json.loads(line)
+            if message.get('id') == request_id:
+                if 'error' in message:
+                    raise RuntimeError(f"{method} failed: {message['error']}")
+                return message['result']
+        raise RuntimeError(f"Server exited before answering {method}")
+
+    def close(self):
+        self.process.stdin.close()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+def run_once(env):
+    """Launch a server and return the milliseconds from launch to each response"""
+    started = time.perf_counter()
+    session = _StdioSession(env)
+    try:
+        timings = {}
+        session.request('initialize', {
+            'protocolVersion': '2024-11-05', 'capabilities': {},
+            'clientInfo': {'name': 'bench_startup', 'version': '0'}})
+        timings['initialize_ms'] = (time.perf_counter() - started) * 1000
+        session.send('notifications/initialized', notification=True)
+
+        for name, tool, arguments in FIRST_CALLS:
+            result = session.request('tools/call', {'name': tool, 'arguments': arguments})
+            text = ''.join(block.get('text', '') for block in result.get('content', []))
+            if result.get('isError') or text.startswith('Error'):
+                raise RuntimeError(f"{tool} failed: {text[:500]}")
+            timings[name] = (time.perf_counter() - started) * 1000
+        return timings
+    finally:
+        session.close()
+
+
+def compare(baseline, results, threshold):
+    """Print changes against a baseline; returns True when a timing regressed past threshold"""
+    regressed = False
+    print(f"\n{'Metric':<16} | {'Before':>10} | {'After':>10} | {'Change':>8}")
+    print("-" * 53)
+    for metric, new in results['startup'].items():
+        old = baseline.get('startup', {}).get(metric)
+        if not old:
+            continue
+        change = (new['median'] - old['median']) / old['median']
+        flag = " !" if change > threshold else ""
+        regressed = regressed or bool(flag)
+        print(f"{metric:<16} | {old['median']:>10} | {new['median']:>10} | {change:>+7.0%}{flag}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help='server launches to time')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare against results saved with --output')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='relative change counted as a regression by --compare (default: 0.2)')
+    args = parser.parse_args()
+
+    httpd = fake_gsc.serve(fake_gsc.FakeSearchConsole())
+    workdir = tempfile.mkdtemp(prefix='gsc-bench-')
+    credentials = os.path.join(workdir, 'credentials.json')
+    fake_gsc.write_credentials(credentials, fake_gsc.url(httpd))
+    env = dict(os.environ, GSC_API_ENDPOINT=fake_gsc.url(httpd), GOOGLE_APPLICATION_CREDENTIALS=credentials)
+
+    runs = []
+    for i in range(args.repeat):
+        # A fresh data directory per launch, so every launch starts cold
+        runs.append(run_once(dict(env, GSC_DATA_DIR=os.path.join(workdir, f'data-{i}'))))
+    httpd.shutdown()
+
+    results = {
+        'config': {'repeat': args.repeat},
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'revision': _git_revision()},
+        'startup': {
+            metric: {
+                'min': round(min(run[metric] for run in runs), 1),
+                'median': round(statistics.median(run[metric] for run in runs), 1),
+                'max': round(max(run[metric] for run in runs), 1),
+            }
+            for metric in runs[0]
+        },
+    }
+
+    print(f"{'Metric':<16} | {'Min (ms)':>9} | {'Median (ms)':>11} | {'Max (ms)':>9}")
+    print("-" * 54)
+    for metric, timing in results['startup'].items():
+        print(f"{metric:<16} | {timing['min']:>9} | {timing['median']:>11} | {timing['max']:>9}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(json.load(f), results, args.threshold):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
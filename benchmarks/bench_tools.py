@@ -0,0 +1,257 @@
+"""
+Benchmark every MCP tool in server.py against a local fake Search Console API.
+
+Starts benchmarks/fake_gsc.py in this process, then runs each tool in a fresh
+Python process through FastMCP's call_tool, so each tool's peak RSS and
+allocations are its own. Results are written as sorted, indented JSON, so
+results from two versions can be diffed or compared with --compare.
+
+Usage:
+    python benchmarks/bench_tools.py [--rows N] [--sites N] [--latency SECONDS] [--repeat N]
+                                     [--output FILE] [--compare BASELINE] [--threshold FRACTION]
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.request
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS_DIR)
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '..'))
+
+import fake_gsc  # noqa: E402
+
+SITE = 'https://www.example.com/'
+
+# Arguments for each tool's i-th call. Queries bypass the response cache so
+# every call reaches the (fake) API; sync_site moves to a new week each call
+# so every call has days to sync, and exports write a new file each call.
+SCENARIOS = {
+    'list_sites': lambda i, rows: {},
+    'query_search_analytics': lambda i, rows: {
+        'site_url': SITE, 'start_date': '2024-01-01', 'end_date': '2024-01-28',
+        'dimensions': ['query', 'page'], 'row_limit': rows, 'cache': 'bypass'},
+    'compare_time_periods': lambda i, rows: {
+        'site_url': SITE, 'current_start_date': '2024-02-01', 'current_end_date': '2024-02-28',
+        'previous_start_date': '2024-01-01', 'previous_end_date': '2024-01-28',
+        'dimensions': ['query'], 'row_limit': rows, 'cache': 'bypass',
+        'additional_periods': [{'label': 'yoy', 'start_date': '2023-02-01', 'end_date': '2023-02-28'}]},
+    'get_top_performing_content': lambda i, rows: {
+        'site_url': SITE, 'start_date': '2024-01-01', 'end_date': '2024-01-28',
+        'metric': 'ctr', 'limit': 25, 'cache': 'bypass'},
+    'get_search_trends': lambda i, rows: {
+        'site_url': SITE, 'start_date': '2023-01-01', 'end_date': '2023-12-31',
+        'interval': 'week', 'cache': 'bypass'},
+    'query_multiple_sites': lambda i, rows: {
+        'start_date': '2024-01-01', 'end_date': '2024-01-28',
+        'dimensions': ['device'], 'row_limit': rows, 'cache': 'bypass'},
+    'export_search_analytics': lambda i, rows: {
+        'site_url': SITE, 'start_date': '2024-01-01', 'end_date': '2024-01-28',
+        'dimensions': ['query', 'page'], 'output_path': f'bench-{i}.csv', 'overwrite': True},
+    'sync_site': lambda i, rows: {
+        'site_url': SITE, 'start_date': _week(i)[0], 'end_date': _week(i)[1], 'dimensions': ['query']},
+    'get_api_status': lambda i, rows: {},
+    'clear_cache': lambda i, rows: {},
+}
+
+
+def _week(i):
+    """Return the start and end dates of the i-th week of 2023"""
+    start = time.strftime('%Y-%m-%d', time.gmtime(1672531200 + i * 7 * 86400))
+    end = time.strftime('%Y-%m-%d', time.gmtime(1672531200 + (i * 7 + 6) * 86400))
+    return start, end
+
+
+def _fake_stats():
+    with urllib.request.urlopen(os.environ['GSC_API_ENDPOINT'] + '_stats') as response:
+        return json.load(response)
+
+
+def _call(server, name, arguments):
+    """Call a tool through FastMCP and return its text output"""
+    result = asyncio.run(server.mcp.call_tool(name, arguments))
+    content = result[0] if isinstance(result, tuple) else result
+    return "".join(getattr(block, 'text', '') for block in content)
+
+
+def _max_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def run_worker(name, rows, repeat):
+    """Benchmark one tool in this process and print the results as JSON"""
+    started = time.perf_counter()
+    import server
+    import_ms = (time.perf_counter() - started) * 1000
+    rss_after_import = _max_rss_mb()
+
+    # The first call also loads credentials and builds the API client
+    started = time.perf_counter()
+    output = _call(server, name, SCENARIOS[name](0, rows))
+    cold_ms = (time.perf_counter() - started) * 1000
+    if output.startswith('Error'):
+        raise SystemExit(f"{name} failed: {output[:500]}")
+
+    latencies = []
+    api_rows = api_requests = 0
+    for i in range(1, repeat + 1):
+        before = _fake_stats()
+        started = time.perf_counter()
+        output = _call(server, name, SCENARIOS[name](i, rows))
+        latencies.append(time.perf_counter() - started)
+        after = _fake_stats()
+        api_rows += after['rows'] - before['rows']
+        api_requests += after['requests'] - before['requests']
+
+    # Allocations are traced on a separate call; tracing slows everything down
+    tracemalloc.start()
+    _call(server, name, SCENARIOS[name](repeat + 1, rows))
+    _, alloc_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    median = statistics.median(latencies)
+    print(json.dumps({
+        'import_ms': round(import_ms, 1),
+        'cold_ms': round(cold_ms, 1),
+        'latency_ms': {
+            'min': round(min(latencies) * 1000, 1),
+            'median': round(median * 1000, 1),
+            'max': round(max(latencies) * 1000, 1),
+        },
+        'api_requests_per_call': api_requests / repeat,
+        'api_rows_per_call': api_rows / repeat,
+        'rows_per_sec': round(api_rows / repeat / median) if median else 0,
+        'output_bytes': len(output.encode('utf-8')),
+        'rss_after_import_mb': round(rss_after_import, 1),
+        'peak_rss_mb': round(_max_rss_mb(), 1),
+        'alloc_peak_mb': round(alloc_peak / (1024 * 1024), 2),
+    }))
+
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARKS_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _tool_names(env):
+    """List the server's tools in a separate process, like the benchmarks themselves"""
+    code = "import asyncio, server; print('\\n'.join(t.name for t in asyncio.run(server.mcp.list_tools())))"
+    names = subprocess.run([sys.executable, '-c', code], cwd=os.path.join(BENCHMARKS_DIR, '..'), env=env,
+                           capture_output=True, text=True, check=True).stdout.split()
+    return names
+
+
+def compare(baseline, results, threshold):
+    """Print changes against a baseline; returns True when a metric regressed past threshold"""
+    checks = [
+        ('latency (ms)', lambda r: r['latency_ms']['median'], False),
+        ('rows/sec', lambda r: r['rows_per_sec'], True),
+        ('peak RSS (MB)', lambda r: r['peak_rss_mb'], False),
+        ('alloc peak (MB)', lambda r: r['alloc_peak_mb'], False),
+    ]
+    regressed = False
+    print(f"\n{'Tool':<28} | {'Metric':<16} | {'Before':>10} | {'After':>10} | {'Change':>8}")
+    print("-" * 84)
+    for name, result in results['tools'].items():
+        before = baseline['tools'].get(name)
+        if not before or 'skipped' in before or 'skipped' in result:
+            continue
+        for metric, value, higher_is_better in checks:
+            old, new = value(before), value(result)
+            if not old:
+                continue
+            change = (new - old) / old
+            worse = -change if higher_is_better else change
+            flag = " !" if worse > threshold else ""
+            regressed = regressed or bool(flag)
+            print(f"{name:<28} | {metric:<16} | {old:>10} | {new:>10} | {change:>+7.0%}{flag}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10000, help='rows per report with non-date dimensions')
+    parser.add_argument('--sites', type=int, default=5, help='number of verified sites')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every API request')
+    parser.add_argument('--repeat', type=int, default=5, help='timed calls per tool')
+    parser.add_argument('--tools', nargs='*', help='only benchmark these tools')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare against results saved with --output')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='relative change counted as a regression by --compare (default: 0.2)')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        return run_worker(args.worker, args.rows, args.repeat)
+
+    fake = fake_gsc.FakeSearchConsole(args.rows, args.sites, args.latency)
+    httpd = fake_gsc.serve(fake)
+    workdir = tempfile.mkdtemp(prefix='gsc-bench-')
+    credentials = os.path.join(workdir, 'credentials.json')
+    fake_gsc.write_credentials(credentials, fake_gsc.url(httpd))
+
+    env = dict(os.environ, GSC_API_ENDPOINT=fake_gsc.url(httpd), GOOGLE_APPLICATION_CREDENTIALS=credentials,
+               GSC_DATA_DIR=os.path.join(workdir, 'data'), GSC_OUTPUT_MAX_BYTES='0')
+
+    results = {
+        'config': {'rows': args.rows, 'sites': args.sites, 'latency': args.latency, 'repeat': args.repeat},
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'revision': _git_revision()},
+        'tools': {},
+    }
+
+    print(f"{'Tool':<28} | {'Median (ms)':>11} | {'Cold (ms)':>9} | {'Rows/s':>9} | {'Peak RSS (MB)':>13} | {'Alloc (MB)':>10}")
+    print("-" * 97)
+    for name in _tool_names(env):
+        if args.tools and name not in args.tools:
+            continue
+        if name not in SCENARIOS:
+            results['tools'][name] = {'skipped': 'no scenario'}
+            print(f"{name:<28} | skipped: no scenario in SCENARIOS")
+            continue
+
+        # A fresh data directory per tool, so no tool sees another's cache
+        tool_env = dict(env, GSC_DATA_DIR=os.path.join(workdir, 'data', name))
+        worker = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--worker', name,
+             '--rows', str(args.rows), '--repeat', str(args.repeat)],
+            cwd=os.path.join(BENCHMARKS_DIR, '..'), env=tool_env, capture_output=True, text=True)
+        if worker.returncode != 0:
+            results['tools'][name] = {'skipped': (worker.stderr or worker.stdout).strip().splitlines()[-1]}
+            print(f"{name:<28} | failed: {results['tools'][name]['skipped']}")
+            continue
+
+        result = results['tools'][name] = json.loads(worker.stdout.strip().splitlines()[-1])
+        print(f"{name:<28} | {result['latency_ms']['median']:>11} | {result['cold_ms']:>9} | "
+              f"{result['rows_per_sec']:>9} | {result['peak_rss_mb']:>13} | {result['alloc_peak_mb']:>10}")
+
+    httpd.shutdown()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(json.load(f), results, args.threshold):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
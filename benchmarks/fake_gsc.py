@@ -0,0 +1,200 @@
+"""
+A local stand-in for the Search Console API, for benchmarks.
+
+Serves the OAuth token endpoint, sites.list and searchanalytics.query over
+HTTP, with deterministic synthetic rows. Point the server at it with
+GSC_API_ENDPOINT and a service account file whose token_uri is the fake's
+/token URL (see write_credentials).
+
+Usage:
+    python benchmarks/fake_gsc.py [--rows N] [--sites N] [--latency SECONDS] [--port PORT]
+"""
+import argparse
+import datetime
+import functools
+import json
+import math
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+import rsa
+
+# Values of the low-cardinality dimensions
+COUNTRIES = ['usa', 'gbr', 'deu', 'fra', 'ind', 'bra', 'can', 'aus']
+DEVICES = ['DESKTOP', 'MOBILE', 'TABLET']
+
+
+class FakeSearchConsole:
+    """Synthetic Search Console data and request counters"""
+
+    def __init__(self, rows=10000, sites=5, latency=0.0, seed=0):
+        self.rows = rows
+        self.sites = [f'https://www{i}.example.com/' if i else 'https://www.example.com/' for i in range(sites)]
+        self.latency = latency
+        self.seed = seed
+        self.stats = {'requests': 0, 'rows': 0, 'bytes': 0}
+        self._lock = threading.Lock()
+
+    def report(self, site_url, start_date, end_date, dimensions, search_type):
+        """Return the full, clicks-ordered report for a query"""
+        return self._report(site_url, start_date, end_date, tuple(dimensions), search_type)
+
+    @functools.lru_cache(maxsize=64)
+    def _report(self, site_url, start_date, end_date, dimensions, search_type):
+        start = datetime.date.fromisoformat(start_date)
+        days = (datetime.date.fromisoformat(end_date) - start).days + 1
+        if days < 1:
+            return []
+
+        # Reports have the configured size, capped at the number of distinct key
+        # tuples the dimensions allow: like the API's, no two rows share their keys
+        cardinality = {'date': days, 'country': len(COUNTRIES), 'device': len(DEVICES)}
+        count = min(self.rows, math.prod(cardinality.get(d, self.rows) for d in dimensions))
+
+        rng = random.Random(f'{self.seed}|{site_url}|{start_date}|{end_date}|{dimensions}|{search_type}')
+        rows = []
+        for i in range(count):
+            # Date, country and device are digits of i in a mixed radix, so their
+            # combinations are unique; query and page values come from i itself
+            keys = []
+            stride = 1
+            for dimension in dimensions:
+                digit = i // stride % cardinality.get(dimension, 1)
+                stride *= cardinality.get(dimension, 1)
+                if dimension == 'date':
+                    keys.append((start + datetime.timedelta(days=digit)).isoformat())
+                elif dimension == 'country':
+                    keys.append(COUNTRIES[digit])
+                elif dimension == 'device':
+                    keys.append(DEVICES[digit])
+                elif dimension == 'page':
+                    keys.append(f'https://www.example.com/section-{i % 40}/page-{i}')
+                else:
+                    keys.append(f'example {dimension} {i}')
+            impressions = rng.randint(1, 10000) * (days if not dimensions else 1)
+            clicks = rng.randint(0, impressions // 4)
+            rows.append({
+                'keys': keys,
+                'clicks': clicks,
+                'impressions': impressions,
+                'ctr': clicks / impressions,
+                'position': round(rng.uniform(1, 60), 4),
+            })
+        rows.sort(key=lambda row: -row['clicks'])
+        return rows
+
+    def query(self, site_url, body):
+        """Answer a searchanalytics.query request body"""
+        rows = self.report(site_url, body['startDate'], body['endDate'],
+                           body.get('dimensions', []), body.get('searchType', body.get('type', 'web')))
+        start_row = body.get('startRow', 0)
+        page = rows[start_row:start_row + body.get('rowLimit', 1000)]
+        with self._lock:
+            self.stats['rows'] += len(page)
+        if not page:
+            return {'responseAggregationType': 'byProperty'}
+        return {'rows': page, 'responseAggregationType': 'byProperty'}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Routes requests to the FakeSearchConsole on the server"""
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, payload, status=200):
+        body = json.dumps(payload).encode('utf-8')
+        fake = self.server.fake
+        with fake._lock:
+            fake.stats['bytes'] += len(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _count_request(self):
+        fake = self.server.fake
+        with fake._lock:
+            fake.stats['requests'] += 1
+        if fake.latency:
+            threading.Event().wait(fake.latency)
+
+    def do_GET(self):
+        fake = self.server.fake
+        if self.path.startswith('/_stats'):
+            return self._send(fake.stats)
+        if self.path.split('?')[0].rstrip('/').endswith('/sites'):
+            self._count_request()
+            return self._send({'siteEntry': [
+                {'siteUrl': site, 'permissionLevel': 'siteOwner'} for site in fake.sites
+            ]})
+        self._send({'error': {'code': 404, 'message': f'Not found: {self.path}'}}, 404)
+
+    def do_POST(self):
+        fake = self.server.fake
+        raw = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path.startswith('/token'):
+            return self._send({'access_token': 'fake-token', 'expires_in': 3600, 'token_type': 'Bearer'})
+        if self.path.split('?')[0].endswith('/searchAnalytics/query'):
+            self._count_request()
+            site_url = self.path.split('/sites/', 1)[1].split('/searchAnalytics')[0]
+            return self._send(fake.query(unquote(site_url), json.loads(raw)))
+        self._send({'error': {'code': 404, 'message': f'Not found: {self.path}'}}, 404)
+
+
+def serve(fake, port=0):
+    """Start serving the fake on a background thread; returns the HTTP server"""
+    httpd = ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+    httpd.daemon_threads = True
+    httpd.fake = fake
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
+def url(httpd):
+    """Return the root URL of a running fake"""
+    return f'http://127.0.0.1:{httpd.server_port}/'
+
+
+def write_credentials(path, root_url):
+    """Write a service account file whose tokens come from the fake"""
+    # rsa is already installed with google-auth. The fake never checks signatures,
+    # so a 1024-bit key does; pure-Python 2048-bit keys take seconds to generate.
+    _, key = rsa.newkeys(1024)
+    pem = key.save_pkcs1().decode('ascii')
+    with open(path, 'w') as f:
+        json.dump({
+            'type': 'service_account',
+            'project_id': 'benchmark',
+            'private_key_id': 'benchmark',
+            'private_key': pem,
+            'client_email': 'benchmark@benchmark.iam.gserviceaccount.com',
+            'client_id': '0',
+            'token_uri': root_url + 'token',
+        }, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10000, help='rows per report with non-date dimensions')
+    parser.add_argument('--sites', type=int, default=5, help='number of verified sites')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every API request')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--credentials', default='fake-credentials.json', help='service account file to write')
+    args = parser.parse_args()
+
+    httpd = serve(FakeSearchConsole(args.rows, args.sites, args.latency), args.port)
+    write_credentials(args.credentials, url(httpd))
+    print(f"Serving a fake Search Console API at {url(httpd)}")
+    print(f"  GSC_API_ENDPOINT={url(httpd)} GOOGLE_APPLICATION_CREDENTIALS={args.credentials}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        httpd.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,53 +1,2017 @@
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+import asyncio
+import bisect
+import contextlib
+import contextvars
+import csv
+import datetime
+import fnmatch
+import functools
+import hashlib
+import heapq
+import http.server
+import importlib
+import inspect
+import itertools
+import json
+import logging
 import os
-import pandas as pd
-from io import StringIO
+import random
+import re
+import sqlite3
+import threading
+import time
+import zlib
 
 from mcp.server.fastmcp import FastMCP, Context
 
+
+class _LazyModule:
+    """
+    A module that is only imported when one of its attributes is first used.
+
+    MCP clients start a new server process for every session, and pandas,
+    numpy and the Google API client stack take most of the import time, so
+    they are loaded by the first tool call that needs them rather than before
+    the server can answer initialize.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            # import_module holds the import lock, so concurrent first uses are safe
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+np = _LazyModule('numpy')
+pd = _LazyModule('pandas')
+httplib2 = _LazyModule('httplib2')
+google_auth_httplib2 = _LazyModule('google_auth_httplib2')
+service_account = _LazyModule('google.oauth2.service_account')
+discovery = _LazyModule('googleapiclient.discovery')
+api_errors = _LazyModule('googleapiclient.errors')
+pa = _LazyModule('pyarrow')
+pq = _LazyModule('pyarrow.parquet')
+
 # OAuth 2.0 scope required for Search Console API
 SCOPES = ['https://www.googleapis.com/auth/webmasters.readonly']
 
-# Create a simple MCP server
-mcp = FastMCP(
-    "Search Console Analytics",
-    dependencies=["google-api-python-client", "google-auth", "pandas"]
-)
+# Refresh access tokens this long before they expire, so no request races the expiry
+TOKEN_REFRESH_MARGIN = datetime.timedelta(minutes=5)
+
+# Socket timeout (seconds) for Search Console API requests
+HTTP_TIMEOUT = 120
+
+# Alternative root URL for the Search Console API, e.g. a local fake for benchmarks
+API_ENDPOINT = os.environ.get('GSC_API_ENDPOINT')
+
+# Maximum number of rows the Search Analytics API returns per request
+API_MAX_ROWS = 25000
+
+# Threads used to prefetch the next page of paginated queries
+PREFETCH_WORKERS = 8
+
+# Threads used to run independent queries (e.g. comparison periods) concurrently
+QUERY_WORKERS = 8
+
+# Tool calls that may run at once; further calls wait for a free slot
+MAX_CONCURRENT_CALLS = int(os.environ.get('GSC_MAX_CONCURRENT_CALLS', 16))
+
+# Date-range chunks of one query fetched at once (see chunk_by)
+CHUNK_WORKERS = int(os.environ.get('GSC_CHUNK_WORKERS', 8))
+
+# Sites queried at once by query_multiple_sites
+FANOUT_WORKERS = int(os.environ.get('GSC_FANOUT_WORKERS', 8))
+
+# Local data directory for the response cache and the synced data store
+DATA_DIR = os.environ.get(
+    'GSC_DATA_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'gsc-mcp-server'))
+
+# Directory that relative export_search_analytics paths are resolved against
+EXPORT_DIR = os.environ.get('GSC_EXPORT_DIR', os.path.join(DATA_DIR, 'exports'))
+
+# File formats written by export_search_analytics
+EXPORT_FORMATS = ['csv', 'parquet']
+
+# Size limit of the on-disk response cache; set to 0 to disable caching
+CACHE_MAX_BYTES = int(os.environ.get('GSC_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+
+# Search Console keeps revising the most recent days; older data is final
+DATA_FINALIZATION_DAYS = 3
+
+# How long responses that include not-yet-final days stay cached
+RECENT_DATA_TTL = datetime.timedelta(minutes=30)
+
+# Response cache modes accepted by the tools
+CACHE_MODES = ['use', 'refresh', 'bypass']
+
+# Dimension filters accepted by the tools, as in the API's dimensionFilterGroups
+FILTER_DIMENSIONS = ['query', 'page', 'country', 'device']
+FILTER_OPERATORS = ['equals', 'notEquals', 'contains', 'notContains', 'includingRegex', 'excludingRegex']
+
+# Ways to split a query's date range into sub-queries, and their length in days
+CHUNK_DAYS = {'none': None, 'day': 1, 'week': 7}
+
+# Request rate limits (requests per second). Search Console allows 1,200
+# queries per minute per site and 40,000 per minute per project.
+SITE_QPS = float(os.environ.get('GSC_SITE_QPS', 20))
+PROJECT_QPS = float(os.environ.get('GSC_PROJECT_QPS', 600))
+
+# Retries of rate-limited and transient API errors, with exponential backoff
+MAX_RETRIES = 5
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 32.0
+
+# Request priorities; lower values are scheduled first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+# Rows with fewer impressions than this are left out of ctr and position
+# rankings by default, since a handful of impressions says little about either
+TOP_CONTENT_MIN_IMPRESSIONS = 10
+
+# site_url of the rows combining every site in query_multiple_sites
+ALL_SITES = '(all sites)'
+
+# Output formats accepted by the tools
+OUTPUT_FORMATS = ['table', 'csv', 'jsonl', 'columnar-json']
+
+# Maximum size of a tool's output in bytes; longer results are cut at a row
+# boundary and end with a summary of the rows left out (0 disables the limit)
+OUTPUT_MAX_BYTES = int(os.environ.get('GSC_OUTPUT_MAX_BYTES', 200000))
+
+# Append a per-phase timing breakdown to every tool's output
+DEBUG_TIMINGS = os.environ.get('GSC_DEBUG_TIMINGS') == '1'
+
+# Port for a Prometheus text endpoint at /metrics (0 disables it)
+METRICS_PORT = int(os.environ.get('GSC_METRICS_PORT', 0))
+
+# JSON file of sites and queries to keep warm in the cache in the background
+# (see _CacheWarmer); unset disables the warmer
+WARM_CONFIG = os.environ.get('GSC_WARM_CONFIG')
+
+# Queries warmed for each site when the config doesn't list any
+WARM_QUERIES = [
+    {'days': 28, 'dimensions': ['page']},
+    {'days': 28, 'dimensions': ['query']},
+    {'days': 28, 'dimensions': ['date']},
+]
+
+# Transport: stdio (one client per server process) or streamable-http (one
+# service for many clients)
+TRANSPORTS = ['stdio', 'streamable-http']
+TRANSPORT = os.environ.get('GSC_TRANSPORT', 'stdio')
+
+# Address and worker processes of the streamable HTTP transport
+HTTP_HOST = os.environ.get('GSC_HTTP_HOST', '127.0.0.1')
+HTTP_PORT = int(os.environ.get('GSC_HTTP_PORT', 8000))
+HTTP_WORKERS = int(os.environ.get('GSC_HTTP_WORKERS', 1))
+
+# Requests each HTTP worker accepts at once; further requests get a 503
+# (0 disables the limit). Tool calls beyond GSC_MAX_CONCURRENT_CALLS wait for a slot.
+HTTP_MAX_REQUESTS = int(os.environ.get('GSC_HTTP_MAX_REQUESTS', 64))
+
+# Seconds a stopping HTTP worker waits for running requests before cancelling them
+HTTP_SHUTDOWN_TIMEOUT = int(os.environ.get('GSC_HTTP_SHUTDOWN_TIMEOUT', 30))
+
+# Server processes started together; with more than one, metrics are per process
+SERVER_PROCESSES = HTTP_WORKERS if TRANSPORT == 'streamable-http' else 1
+
+# Phases of a tool call, in the order they are listed in timing breakdowns
+PHASES = ['queued', 'tool', 'credentials', 'build', 'rate_limit', 'backoff', 'network',
+          'cache', 'store', 'decode', 'merge', 'format']
+
+logger = logging.getLogger(__name__)
+
+# Create a simple MCP server
+mcp = FastMCP(
+    "Search Console Analytics",
+    host=HTTP_HOST,
+    port=HTTP_PORT,
+    dependencies=["google-api-python-client", "google-auth", "pandas"]
+)
+
+
+class _Metrics:
+    """
+    Process-wide counters and per-phase timings.
+    
+    Phases are attributed to the tool whose call is running in the current
+    context, or to 'background' outside tool calls.
+    """
+    
+    COUNTERS = ['tool_calls', 'tool_errors', 'api_calls', 'api_errors', 'retries',
+                'rows_received', 'response_bytes', 'cache_hits', 'cache_misses',
+                'coalesced_queries', 'partial_cache_hits', 'cancelled_calls']
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = dict.fromkeys(self.COUNTERS, 0)
+        self._phases = {}
+        self._active_calls = 0
+    
+    def count(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+    
+    def call_started(self):
+        with self._lock:
+            self._active_calls += 1
+    
+    def call_finished(self):
+        with self._lock:
+            self._active_calls -= 1
+    
+    def active_calls(self):
+        """Return the number of tool calls running or waiting for a worker"""
+        return self._active_calls
+    
+    def observe(self, tool, phase, seconds):
+        with self._lock:
+            entry = self._phases.setdefault((tool, phase), [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+    
+    def snapshot(self):
+        """Return the counters and, per tool and phase, the count, total and longest time"""
+        with self._lock:
+            counters = dict(self._counters)
+            phases = {key: list(entry) for key, entry in self._phases.items()}
+            active_calls = self._active_calls
+        
+        timings = {}
+        for (tool, phase), (count, total, longest) in sorted(phases.items()):
+            timings.setdefault(tool, {})[phase] = {
+                'count': count, 'total_ms': round(total * 1000, 3), 'max_ms': round(longest * 1000, 3)}
+        return {'counters': counters, 'active_calls': active_calls, 'phases': timings}
+    
+    def prometheus(self):
+        """Render the metrics in the Prometheus text format"""
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in snapshot['counters'].items():
+            lines.append(f"# TYPE gsc_{name}_total counter")
+            lines.append(f"gsc_{name}_total {value}")
+        lines.append("# TYPE gsc_active_calls gauge")
+        lines.append(f"gsc_active_calls {snapshot['active_calls']}")
+        
+        lines.append("# TYPE gsc_phase_seconds summary")
+        for tool, phases in snapshot['phases'].items():
+            for phase, entry in phases.items():
+                labels = f'tool="{tool}",phase="{phase}"'
+                lines.append(f"gsc_phase_seconds_sum{{{labels}}} {entry['total_ms'] / 1000}")
+                lines.append(f"gsc_phase_seconds_count{{{labels}}} {entry['count']}")
+        
+        lines.append("# TYPE gsc_phase_seconds_max gauge")
+        for tool, phases in snapshot['phases'].items():
+            for phase, entry in phases.items():
+                lines.append(f'gsc_phase_seconds_max{{tool="{tool}",phase="{phase}"}} {entry["max_ms"] / 1000}')
+        return "\n".join(lines) + "\n"
+
+
+_metrics = _Metrics()
+
+
+class _CallTimings:
+    """Phase timings of a single tool call, collected from any thread working on it"""
+    
+    def __init__(self, tool):
+        self.tool = tool
+        self._lock = threading.Lock()
+        self._phases = {}
+    
+    def add(self, phase, seconds):
+        with self._lock:
+            entry = self._phases.setdefault(phase, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+    
+    def summary(self):
+        """Format the breakdown; phases on parallel threads can add up to more than the total"""
+        with self._lock:
+            phases = dict(self._phases)
+        parts = []
+        for phase in sorted(phases, key=lambda p: PHASES.index(p) if p in PHASES else len(PHASES)):
+            count, total = phases[phase]
+            parts.append(f"{phase} {total * 1000:.1f} ms" + (f" ({count}x)" if count > 1 else ""))
+        return "Timings: " + " | ".join(parts)
+
+
+# Timings of the tool call running in the current context
+_current_call = contextvars.ContextVar('gsc_current_call', default=None)
+
+
+class _Cancelled(Exception):
+    """Raised in a tool call's threads once the client has cancelled it"""
+
+
+class _CallProgress:
+    """
+    Progress and cancellation of a single tool call, shared by every thread working on it.
+    
+    Pages are counted as they arrive and sent to the client as MCP progress
+    notifications, with the number of pages still expected. Queries known in
+    advance are planned, so the estimate includes pages that haven't started.
+    
+    One sender on the event loop delivers notifications in order, skipping to
+    the latest when pages arrive faster than it sends, so progress never goes
+    down. The call's result waits for the sender, so no progress follows it.
+    """
+    
+    def __init__(self, ctx, loop):
+        self.ctx = ctx
+        self.loop = loop
+        self.cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+        self._pages = 0
+        self._rows = 0
+        self._expected = 0
+        self._planned = 0
+        self._latest = None
+        self._sender = None
+        self._finished = False
+    
+    def plan(self, queries):
+        """Expect a page from each of this many queries that are about to start"""
+        with self._lock:
+            self._planned += queries
+            self._expected += queries
+    
+    def query_started(self):
+        with self._lock:
+            if self._planned:
+                self._planned -= 1
+            else:
+                self._expected += 1
+    
+    def page_fetched(self, rows, more):
+        """Count a page of rows; more is whether the same query has another page to fetch"""
+        with self._lock:
+            self._pages += 1
+            self._rows += rows
+            self._expected = max(self._expected + (1 if more else 0), self._pages)
+            pages, expected = self._pages, self._expected
+            message = f"{pages} pages ({self._rows} rows) fetched"
+            
+            remaining = expected - pages
+            if remaining:
+                seconds = (time.perf_counter() - self._started) / pages * remaining
+                message += f", about {remaining} more (~{seconds:.0f}s left)"
+            
+            if self.ctx is None or self.loop is None or self.cancelled.is_set() or self._finished:
+                return
+            # Don't wait for delivery, like _notify; a running sender picks this up
+            self._latest = (pages, expected, message)
+            if self._sender is None:
+                self._sender = asyncio.run_coroutine_threadsafe(self._send(), self.loop)
+    
+    async def _send(self):
+        """Send the latest progress until none is left, one notification at a time"""
+        while True:
+            with self._lock:
+                latest, self._latest = self._latest, None
+                if latest is None or self.cancelled.is_set():
+                    self._sender = None
+                    return
+            try:
+                await self.ctx.report_progress(*latest)
+            except Exception as e:
+                logger.debug("Progress notification failed: %s", e)
+    
+    def finish(self):
+        """Stop taking progress once the call has returned; returns the sender still running, if any"""
+        with self._lock:
+            self._finished = True
+            return self._sender
+    
+    def cancel(self):
+        """Stop the call's work at its next check and wake requests waiting for a rate limit slot"""
+        self.cancelled.set()
+        _scheduler.wake()
+
+
+# Progress of the tool call running in the current context
+_current_progress = contextvars.ContextVar('gsc_current_progress', default=None)
+
+
+def _check_cancelled():
+    """Raise _Cancelled if the client has cancelled the current tool call"""
+    progress = _current_progress.get()
+    if progress is not None and progress.cancelled.is_set():
+        raise _Cancelled("Cancelled by the client")
+
+
+def _plan_queries(queries):
+    """Tell the current call's progress how many queries are about to start"""
+    progress = _current_progress.get()
+    if progress is not None:
+        progress.plan(queries)
+
+
+def _sleep(seconds):
+    """Sleep, waking early and raising _Cancelled if the current call is cancelled"""
+    progress = _current_progress.get()
+    if progress is None:
+        time.sleep(seconds)
+        return
+    progress.cancelled.wait(seconds)
+    _check_cancelled()
+
+
+def _record(phase, seconds):
+    """Add time spent in a phase to the metrics and the current tool call"""
+    call = _current_call.get()
+    _metrics.observe(call.tool if call else 'background', phase, seconds)
+    if call is not None:
+        call.add(phase, seconds)
+
+
+@contextlib.contextmanager
+def _span(phase):
+    """Time the enclosed block as a phase of the current tool call"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(phase, time.perf_counter() - started)
+
+
+def _submit(executor, fn, *args):
+    """Submit work to an executor in a copy of the current context, so its timings count towards the current call"""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+@functools.lru_cache(maxsize=None)
+def _metered_http_class():
+    """Define the metered transport on first use, so google_auth_httplib2 is imported lazily"""
+    
+    class _MeteredHttp(google_auth_httplib2.AuthorizedHttp):
+        """Authorized transport that counts the bytes of every response"""
+        
+        def request(self, *args, **kwargs):
+            response, content = super().request(*args, **kwargs)
+            _metrics.count('response_bytes', len(content or b''))
+            return response, content
+    
+    return _MeteredHttp
+
+
+class _SearchConsoleClient:
+    """
+    Process-wide Search Console client shared by all tools.
+
+    Credentials are loaded once and only reloaded when the file behind
+    GOOGLE_APPLICATION_CREDENTIALS changes, access tokens are refreshed ahead
+    of expiry, and the API service is built once from the discovery document
+    bundled with google-api-python-client. httplib2 connections are not
+    thread-safe, so every thread keeps its own keep-alive transport.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._credentials = None
+        self._credentials_key = None
+        # Bumped whenever credentials are reloaded so threads drop stale transports
+        self._generation = 0
+        self._service = None
+
+    def _credentials_file_key(self):
+        """Return (path, mtime, size) of the credentials file, used to detect changes"""
+        credentials_file = os.environ.get('GOOGLE_APPLICATION_CREDENTIALS')
+
+        if not credentials_file:
+            raise RuntimeError("GOOGLE_APPLICATION_CREDENTIALS environment variable not set")
+
+        try:
+            stat = os.stat(credentials_file)
+        except FileNotFoundError:
+            raise RuntimeError(f"Credentials file not found at {credentials_file}") from None
+
+        return (credentials_file, stat.st_mtime_ns, stat.st_size)
+
+    def _token_is_fresh(self):
+        credentials = self._credentials
+        if not credentials.token or credentials.expiry is None:
+            return False
+        # google-auth stores expiry as a naive UTC datetime
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        return credentials.expiry - now > TOKEN_REFRESH_MARGIN
+
+    def credentials(self):
+        """Return the cached credentials, reloading and refreshing them as needed."""
+        key = self._credentials_file_key()
+
+        if key == self._credentials_key and self._token_is_fresh():
+            return self._credentials
+
+        with self._lock, _span('credentials'):
+            if key != self._credentials_key:
+                self._credentials = service_account.Credentials.from_service_account_file(
+                    key[0], scopes=SCOPES)
+                self._credentials_key = key
+                self._generation += 1
+
+            # Another thread may have refreshed the token while we waited for the lock
+            if not self._token_is_fresh():
+                self._credentials.refresh(
+                    google_auth_httplib2.Request(httplib2.Http(timeout=HTTP_TIMEOUT)))
+
+            return self._credentials
+
+    def service(self):
+        """Return the shared Search Console API service."""
+        self.credentials()
+
+        if self._service is None:
+            with self._lock:
+                if self._service is None:
+                    # Requests are always executed with a per-thread authorized
+                    # transport (see execute), so the service gets a plain one
+                    with _span('build'):
+                        self._service = discovery.build(
+                            'webmasters', 'v3',
+                            http=httplib2.Http(timeout=HTTP_TIMEOUT),
+                            static_discovery=True,
+                            cache_discovery=False,
+                            client_options={'api_endpoint': API_ENDPOINT} if API_ENDPOINT else None)
+
+        return self._service
+
+    def _http(self):
+        """Return this thread's authorized keep-alive transport."""
+        credentials = self.credentials()
+        local = self._local
+
+        if getattr(local, 'generation', None) != self._generation:
+            local.http = _metered_http_class()(credentials, http=httplib2.Http(timeout=HTTP_TIMEOUT))
+            local.generation = self._generation
+
+        return local.http
+
+    def execute(self, request):
+        """Execute an API request built from service() on this thread's transport."""
+        http = self._http()
+        _metrics.count('api_calls')
+        with _span('network'):
+            return request.execute(http=http)
+
+
+_client = _SearchConsoleClient()
+
+
+class _TokenBucket:
+    """Token bucket refilled at rate tokens per second, holding at most one second's worth"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self):
+        """Return the seconds until a token is available"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class _BucketStore:
+    """
+    Token buckets shared by every server process using the same data directory.
+
+    Each chat's stdio server and each HTTP worker is its own process; keeping
+    the buckets in one SQLite file means together they stay within the quota
+    instead of each one spending all of it. Tokens are checked and taken in
+    one transaction. Without a path, or if the file can't be used, buckets
+    are kept in this process only.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+        self._local = {}
+
+    def _connection(self):
+        if self._conn is None:
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+                conn.execute('PRAGMA journal_mode=WAL')
+                # Losing the last few takes in a crash only lets a few requests through early
+                conn.execute('PRAGMA synchronous=NORMAL')
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS buckets ('
+                    'key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+            except (OSError, sqlite3.Error):
+                # Like the response cache, a store that can't be opened isn't retried
+                self.path = None
+                raise
+            self._conn = conn
+        return self._conn
+
+    def close(self):
+        """Close the database connection; it is reopened on next use"""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def take(self, buckets):
+        """
+        Take a token from every (key, rate) bucket if each one has a token.
+
+        Returns 0 when the tokens were taken, otherwise the seconds until they
+        may be.
+        """
+        with self._lock:
+            if self.path is not None:
+                try:
+                    return self._take_shared(buckets)
+                except (OSError, sqlite3.Error) as e:
+                    logger.warning("Shared rate limits unavailable, limiting this process only: %s", e)
+                    self.path = None
+
+            local = [self._local.setdefault(key, _TokenBucket(rate)) for key, rate in buckets]
+            timeout = max(bucket.wait_time() for bucket in local)
+            if timeout <= 0:
+                for bucket in local:
+                    bucket.take()
+            return timeout
+
+    def _take_shared(self, buckets):
+        conn = self._connection()
+        # Wall-clock time, since monotonic clocks aren't comparable across processes
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            tokens = []
+            for key, rate in buckets:
+                row = conn.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+                capacity = max(rate, 1.0)
+                if row is None:
+                    tokens.append(capacity)
+                else:
+                    tokens.append(min(capacity, row[0] + max(0.0, now - row[1]) * rate))
+            timeout = max(0.0 if available >= 1 else (1 - available) / rate
+                          for available, (_, rate) in zip(tokens, buckets))
+            taken = 1 if timeout <= 0 else 0
+            conn.executemany(
+                'INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)',
+                [(key, available - taken, now) for available, (key, _) in zip(tokens, buckets)])
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return timeout
+
+
+class _RequestScheduler:
+    """
+    Central scheduler every Search Console API call goes through.
+
+    Requests wait for a token from their site's and their project's bucket,
+    which every server process shares (see _BucketStore). Waiting requests
+    in this process for the same site are served in priority order, and
+    background requests also yield to interactive requests for any site.
+    Rate-limited and transient errors are retried with exponential backoff
+    and full jitter.
+    """
+
+    def __init__(self, site_qps, project_qps, buckets=None):
+        self.site_qps = site_qps
+        self.project_qps = project_qps
+        self.buckets = buckets or _BucketStore(None)
+        self._cond = threading.Condition()
+        self._sequence = itertools.count()
+        self._waiting = []
+        self._stats = {'requests': 0, 'retries': 0, 'total_wait': 0.0, 'max_wait': 0.0}
+
+    def _is_next(self, entry):
+        """Return whether no waiting request should be scheduled before this one"""
+        priority, _, site_url = entry
+        for other in self._waiting:
+            if other < entry and (other[2] == site_url or other[0] < priority):
+                return False
+        return True
+
+    def _acquire(self, site_url, project, priority):
+        """Block until the request may be sent; returns the seconds waited"""
+        entry = (priority, next(self._sequence), site_url)
+        started = time.monotonic()
+
+        with self._cond:
+            heapq.heappush(self._waiting, entry)
+            try:
+                while True:
+                    timeout = None
+                    if self._is_next(entry):
+                        buckets = [(f'project:{project}', self.project_qps)]
+                        if site_url:
+                            buckets.append((f'site:{site_url}', self.site_qps))
+                        timeout = self.buckets.take(buckets)
+                        if timeout <= 0:
+                            break
+                    self._cond.wait(timeout)
+                    # A cancelled call gives up its place in the queue
+                    _check_cancelled()
+            finally:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+
+            waited = time.monotonic() - started
+            self._stats['requests'] += 1
+            self._stats['total_wait'] += waited
+            self._stats['max_wait'] = max(self._stats['max_wait'], waited)
+            return waited
+
+    def run(self, fn, site_url=None, project=None, priority=PRIORITY_INTERACTIVE):
+        """Call fn() once the rate limits allow it, retrying retryable errors"""
+        for attempt in range(MAX_RETRIES + 1):
+            with _span('rate_limit'):
+                self._acquire(site_url, project, priority)
+            try:
+                return fn()
+            except Exception as e:
+                if attempt == MAX_RETRIES or not _is_retryable(e):
+                    _metrics.count('api_errors')
+                    raise
+                with self._cond:
+                    self._stats['retries'] += 1
+                _metrics.count('retries')
+                with _span('backoff'):
+                    _sleep(random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)))
+    
+    def wake(self):
+        """Wake every waiting request, so cancelled ones can leave the queue"""
+        with self._cond:
+            self._cond.notify_all()
+
+    def stats(self):
+        """Return queue depths per priority and wait time statistics"""
+        with self._cond:
+            stats = dict(self._stats)
+            stats['interactive_queued'] = sum(1 for e in self._waiting if e[0] == PRIORITY_INTERACTIVE)
+            stats['background_queued'] = sum(1 for e in self._waiting if e[0] != PRIORITY_INTERACTIVE)
+        stats['average_wait'] = stats['total_wait'] / stats['requests'] if stats['requests'] else 0.0
+        return stats
+
+
+def _is_retryable(error):
+    """Return whether an API error is worth retrying after a backoff"""
+    if isinstance(error, api_errors.HttpError):
+        if error.resp.status in (429, 500, 502, 503, 504):
+            return True
+        # Rate limits are also reported as 403 errors with a specific reason
+        return error.resp.status == 403 and (
+            b'rateLimitExceeded' in error.content or b'userRateLimitExceeded' in error.content)
+    return isinstance(error, (TimeoutError, ConnectionError))
+
+
+_scheduler = _RequestScheduler(SITE_QPS, PROJECT_QPS, _BucketStore(os.path.join(DATA_DIR, 'rate_limits.sqlite3')))
+
+
+def _execute_api(request, site_url=None, priority=PRIORITY_INTERACTIVE):
+    """Execute an API request through the scheduler's rate limits and retries"""
+    project = getattr(_client.credentials(), 'project_id', None)
+    return _scheduler.run(lambda: _client.execute(request), site_url, project, priority)
+
+
+def _data_is_final(day):
+    """Return whether Search Console has finalized the data for a YYYY-MM-DD day"""
+    final_before = datetime.date.today() - datetime.timedelta(days=DATA_FINALIZATION_DAYS)
+    return datetime.date.fromisoformat(day) < final_before
+
+
+class _ResponseCache:
+    """
+    On-disk SQLite cache of Search Analytics responses keyed on the normalized request.
+
+    Responses for date ranges that ended before the finalization window never
+    expire; ranges touching recent days expire after RECENT_DATA_TTL. Once the
+    cache grows past max_bytes the least recently used entries are evicted.
+
+    Complete responses of queries grouped by date are also indexed by their
+    date range, so requests for overlapping ranges can reuse their rows.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connection(self):
+        if self._conn is None:
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS responses ('
+                    'key TEXT PRIMARY KEY, site_url TEXT NOT NULL, response BLOB NOT NULL, '
+                    'size INTEGER NOT NULL, expires_at REAL, last_access REAL NOT NULL)')
+                conn.execute('CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)')
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS ranges ('
+                    'key TEXT PRIMARY KEY, family TEXT NOT NULL, start_date TEXT NOT NULL, end_date TEXT NOT NULL)')
+                conn.execute('CREATE INDEX IF NOT EXISTS ranges_family ON ranges (family, start_date)')
+            except (OSError, sqlite3.Error):
+                # A cache that can't be opened won't open on the next query either: turn it off
+                # instead of retrying (and logging) on every request
+                self.max_bytes = 0
+                raise
+            self._conn = conn
+        return self._conn
+
+    def close(self):
+        """Close the database connection; it is reopened on next use"""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    @staticmethod
+    def key(site_url, request_body):
+        """Hash the site and request body, ignoring key order and defaulted fields"""
+        body = dict(request_body)
+        body.setdefault('searchType', 'web')
+        body.setdefault('dimensions', [])
+        normalized = json.dumps([site_url, body], sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(normalized.encode()).hexdigest()
+
+    @classmethod
+    def family(cls, site_url, request_body):
+        """Hash the request without its date range and paging, so overlapping ranges match"""
+        body = {k: v for k, v in request_body.items() if k not in ('startDate', 'endDate', 'startRow', 'rowLimit')}
+        return cls.key(site_url, body)
+
+    @staticmethod
+    def is_complete_daily(request_body, response):
+        """Return whether a response holds every row of a query grouped by date"""
+        return ('date' in (request_body.get('dimensions') or []) and not request_body.get('startRow')
+                and len(response.get('rows', [])) < request_body.get('rowLimit', 1000))
+
+    @staticmethod
+    def expires_at(request_body):
+        """Return when a response should expire, or None once its data is final"""
+        if _data_is_final(request_body['endDate']):
+            return None
+        return time.time() + RECENT_DATA_TTL.total_seconds()
+
+    def get(self, site_url, request_body):
+        """Return the cached response, or None on a miss"""
+        if self.max_bytes <= 0:
+            return None
+
+        key = self.key(site_url, request_body)
+        try:
+            with self._lock:
+                conn = self._connection()
+                entry = conn.execute(
+                    'SELECT response, expires_at FROM responses WHERE key = ?', (key,)).fetchone()
+                if entry is None:
+                    return None
+                if entry[1] is not None and entry[1] < time.time():
+                    conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                    return None
+                conn.execute('UPDATE responses SET last_access = ? WHERE key = ?', (time.time(), key))
+        except (OSError, sqlite3.Error) as e:
+            # A broken cache must never fail a query
+            logger.warning("Response cache read failed: %s", e)
+            return None
+
+        return json.loads(zlib.decompress(entry[0]))
+
+    def expiry(self, site_url, request_body):
+        """Return when the cached response expires (None if never), or when a new one would if it isn't cached"""
+        entry = None
+        if self.max_bytes > 0:
+            try:
+                with self._lock:
+                    entry = self._connection().execute(
+                        'SELECT expires_at FROM responses WHERE key = ?',
+                        (self.key(site_url, request_body),)).fetchone()
+            except (OSError, sqlite3.Error) as e:
+                logger.warning("Response cache read failed: %s", e)
+        return entry[0] if entry is not None else self.expires_at(request_body)
+
+    def put(self, site_url, request_body, response, expires_at=None):
+        """
+        Store a response and evict least recently used entries over the size limit.
+
+        expires_at overrides the expiry computed from the request, for responses
+        built from other cached responses.
+        """
+        if self.max_bytes <= 0:
+            return
+
+        data = zlib.compress(json.dumps(response, separators=(',', ':')).encode())
+        try:
+            with self._lock:
+                conn = self._connection()
+                key = self.key(site_url, request_body)
+                conn.execute(
+                    'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                    (key, site_url, data, len(data), expires_at or self.expires_at(request_body), time.time()))
+                if self.is_complete_daily(request_body, response):
+                    conn.execute(
+                        'INSERT OR REPLACE INTO ranges VALUES (?, ?, ?, ?)',
+                        (key, self.family(site_url, request_body),
+                         request_body['startDate'], request_body['endDate']))
+
+                total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+                if total > self.max_bytes:
+                    for key, size in conn.execute(
+                            'SELECT key, size FROM responses ORDER BY last_access').fetchall():
+                        if total <= self.max_bytes:
+                            break
+                        conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                        conn.execute('DELETE FROM ranges WHERE key = ?', (key,))
+                        total -= size
+        except (OSError, sqlite3.Error) as e:
+            logger.warning("Response cache write failed: %s", e)
+
+    def overlapping(self, site_url, request_body):
+        """
+        Return (start_date, end_date, response, expires_at) of the complete cached
+        response sharing the most days with the requested range, or None.
+        """
+        if self.max_bytes <= 0:
+            return None
+
+        start_date, end_date = request_body['startDate'], request_body['endDate']
+        try:
+            with self._lock:
+                candidates = self._connection().execute(
+                    'SELECT ranges.start_date, ranges.end_date, responses.response, responses.expires_at FROM ranges '
+                    'JOIN responses ON responses.key = ranges.key '
+                    'WHERE family = ? AND start_date <= ? AND end_date >= ? '
+                    'AND (expires_at IS NULL OR expires_at >= ?)',
+                    (self.family(site_url, request_body), end_date, start_date, time.time())).fetchall()
+        except (OSError, sqlite3.Error) as e:
+            logger.warning("Response cache read failed: %s", e)
+            return None
+        if not candidates:
+            return None
+
+        def overlap(candidate):
+            first = max(start_date, candidate[0])
+            last = min(end_date, candidate[1])
+            return (datetime.date.fromisoformat(last) - datetime.date.fromisoformat(first)).days
+
+        best = max(candidates, key=overlap)
+        return best[0], best[1], json.loads(zlib.decompress(best[2])), best[3]
+
+    def invalidate(self, site_url=None):
+        """Remove cached responses for one site, or all of them; returns the number removed"""
+        if self.max_bytes <= 0:
+            return 0
+
+        with self._lock:
+            conn = self._connection()
+            if site_url:
+                cursor = conn.execute('DELETE FROM responses WHERE site_url = ?', (site_url,))
+            else:
+                cursor = conn.execute('DELETE FROM responses')
+            conn.execute('DELETE FROM ranges WHERE key NOT IN (SELECT key FROM responses)')
+            return cursor.rowcount
+
+
+_cache = _ResponseCache(os.path.join(DATA_DIR, 'responses.sqlite3'), CACHE_MAX_BYTES)
+
+
+class _SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into one.
+
+    The first caller runs the function; callers arriving while it runs wait
+    for it and get the same result (or exception) instead of running it again.
+    If the first caller's tool call is cancelled, a waiting caller takes over.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def run(self, key, fn):
+        while True:
+            with self._lock:
+                future = self._calls.get(key)
+                leader = future is None
+                if leader:
+                    future = self._calls[key] = Future()
+            if leader:
+                break
+            
+            _metrics.count('coalesced_queries')
+            try:
+                return future.result()
+            except _Cancelled:
+                # The leader's call was cancelled, not this one: run it again
+                _check_cancelled()
+
+        # The key is removed before the future completes, so a follower that retries
+        # after a cancelled leader starts a new call instead of finding this one again
+        try:
+            result = fn()
+        except BaseException as e:
+            with self._lock:
+                del self._calls[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._calls[key]
+        future.set_result(result)
+        return result
+
+
+_in_flight = _SingleFlight()
+
+
+class _Warehouse:
+    """
+    Local SQLite store of daily Search Analytics rows per site, search type and dimension set.
+
+    sync() only fetches days that are missing or not final yet, so keeping a
+    site current costs one small query a day. Requests whose whole date range
+    is covered by synced days are answered from the store without the API.
+    """
+
+    # Dimensions stored as columns next to the date
+    DIMENSIONS = ['query', 'page', 'country', 'device']
+
+    # Request body fields the store can answer
+    SUPPORTED_FIELDS = {'startDate', 'endDate', 'dimensions', 'searchType', 'dimensionFilterGroups'}
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+        self._staging_ids = itertools.count()
+
+    def _connection(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS rows ('
+                'site_url TEXT NOT NULL, search_type TEXT NOT NULL, dimension_set TEXT NOT NULL, '
+                'date TEXT NOT NULL, query TEXT, page TEXT, country TEXT, device TEXT, '
+                'clicks REAL NOT NULL, impressions REAL NOT NULL, position REAL NOT NULL)')
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS rows_by_day ON rows (site_url, search_type, dimension_set, date)')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS days ('
+                'site_url TEXT NOT NULL, search_type TEXT NOT NULL, dimension_set TEXT NOT NULL, '
+                'date TEXT NOT NULL, final INTEGER NOT NULL, synced_at REAL NOT NULL, '
+                'PRIMARY KEY (site_url, search_type, dimension_set, date))')
+            self._conn = conn
+        return self._conn
+
+    def close(self):
+        """Close the database connection; it is reopened on next use"""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    @staticmethod
+    def dimension_set(dimensions):
+        """Return the key of the dimension set rows are stored under (date is implied)"""
+        return ','.join(sorted(d for d in dimensions or [] if d != 'date'))
+
+    @staticmethod
+    def _days(start_date, end_date):
+        start = datetime.date.fromisoformat(start_date)
+        end = datetime.date.fromisoformat(end_date)
+        return [(start + datetime.timedelta(days=i)).isoformat() for i in range((end - start).days + 1)]
+
+    @staticmethod
+    def day_runs(days):
+        """Group sorted YYYY-MM-DD days into lists of consecutive days"""
+        runs = []
+        for day in days:
+            if runs and runs[-1][-1] == _shift_day(day, -1):
+                runs[-1].append(day)
+            else:
+                runs.append([day])
+        return runs
+
+    def _current_days(self, site_url, search_type, dimension_set, start_date, end_date):
+        """Return the days in range whose stored data is final or was synced recently"""
+        fresh_after = time.time() - RECENT_DATA_TTL.total_seconds()
+        with self._lock:
+            cursor = self._connection().execute(
+                'SELECT date FROM days WHERE site_url = ? AND search_type = ? AND dimension_set = ? '
+                'AND date BETWEEN ? AND ? AND (final = 1 OR synced_at > ?)',
+                (site_url, search_type, dimension_set, start_date, end_date, fresh_after))
+            return {row[0] for row in cursor}
+
+    def covers(self, site_url, request_body):
+        """Return whether the store can answer a request without calling the API"""
+        if not set(request_body) <= self.SUPPORTED_FIELDS:
+            return False
+
+        # Filters run on stored rows, so they can only use the stored dimensions
+        dimensions = request_body.get('dimensions') or []
+        if any(f['dimension'] not in dimensions for f in _request_filters(request_body)):
+            return False
+
+        days = self._days(request_body['startDate'], request_body['endDate'])
+        try:
+            current = self._current_days(
+                site_url, request_body.get('searchType', 'web'),
+                self.dimension_set(request_body.get('dimensions')),
+                request_body['startDate'], request_body['endDate'])
+        except (OSError, sqlite3.Error) as e:
+            # A store that can't be read covers nothing; the query goes to the API
+            logger.warning("Local store read failed: %s", e)
+            return False
+        return len(current) == len(days)
+
+    def sync(self, site_url, start_date, end_date, dimensions=None, search_type='web'):
+        """
+        Fetch the days in range that are missing or not yet final.
+
+        Returns (days synced, rows stored, days already current).
+        """
+        dimension_set = self.dimension_set(dimensions)
+        current = self._current_days(site_url, search_type, dimension_set, start_date, end_date)
+        missing = [day for day in self._days(start_date, end_date) if day not in current]
+
+        # Group missing days into contiguous runs so each run is a single query
+        runs = self.day_runs(missing)
+        _plan_queries(len(runs))
+        futures = [
+            _submit(_query_executor, self._sync_run, site_url, search_type, dimension_set, run[0], run[-1])
+            for run in runs
+        ]
+        rows = sum(future.result() for future in futures)
+
+        return len(missing), rows, len(current)
+
+    def _sync_run(self, site_url, search_type, dimension_set, start_date, end_date):
+        """Replace the stored rows for a contiguous run of days; returns the row count"""
+        query_dimensions = (dimension_set.split(',') if dimension_set else []) + ['date']
+        request_body = {
+            'startDate': start_date,
+            'endDate': end_date,
+            'dimensions': query_dimensions,
+            'searchType': search_type
+        }
+        key = (site_url, search_type, dimension_set)
+
+        # Pages are staged in a temporary table and swapped in with one transaction,
+        # so syncs of the same days (from this process or another) each replace the
+        # range instead of both adding their rows to it
+        staging = f'temp.sync_{next(self._staging_ids)}'
+        with self._lock:
+            self._connection().execute(f'CREATE TABLE {staging} AS SELECT * FROM rows WHERE 0')
+
+        try:
+            # The store keeps the data, so the response cache is bypassed. Syncs
+            # run at background priority so interactive queries go first.
+            row_count = 0
+            for page in _iter_pages(site_url, request_body, cache='bypass', priority=PRIORITY_BACKGROUND):
+                records = []
+                for row in page:
+                    values = dict(zip(query_dimensions, row['keys']))
+                    records.append(key + (values['date'],) + tuple(values.get(d) for d in self.DIMENSIONS) + (
+                        row.get('clicks', 0), row.get('impressions', 0), row.get('position', 0)))
+                with self._lock:
+                    conn = self._connection()
+                    # One transaction per page instead of one per row
+                    conn.execute('BEGIN')
+                    conn.executemany(f'INSERT INTO {staging} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', records)
+                    conn.execute('COMMIT')
+                row_count += len(records)
+
+            # Rows are replaced and days marked synced together, once every page has arrived
+            synced_at = time.time()
+            with self._lock:
+                conn = self._connection()
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    conn.execute(
+                        'DELETE FROM rows WHERE site_url = ? AND search_type = ? AND dimension_set = ? '
+                        'AND date BETWEEN ? AND ?', key + (start_date, end_date))
+                    conn.execute(f'INSERT INTO rows SELECT * FROM {staging}')
+                    conn.executemany(
+                        'INSERT OR REPLACE INTO days VALUES (?, ?, ?, ?, ?, ?)',
+                        [key + (day, int(_data_is_final(day)), synced_at)
+                         for day in self._days(start_date, end_date)])
+                    conn.execute('COMMIT')
+                except BaseException:
+                    conn.execute('ROLLBACK')
+                    raise
+        finally:
+            with self._lock:
+                self._connection().execute(f'DROP TABLE IF EXISTS {staging}')
+
+        # Device and country totals also keep the rollup cube current
+        if set(query_dimensions) <= {'date', 'device', 'country'}:
+            with self._lock:
+                records = self._connection().execute(
+                    'SELECT date, device, country, SUM(clicks), SUM(impressions), SUM(position * impressions) '
+                    'FROM rows WHERE site_url = ? AND search_type = ? AND dimension_set = ? '
+                    'AND date BETWEEN ? AND ? GROUP BY date, device, country',
+                    key + (start_date, end_date)).fetchall()
+            _rollups.store_synced(site_url, search_type, dimension_set, start_date, end_date, records)
+
+        return row_count
+
+    def iter_pages(self, site_url, request_body, max_rows=None):
+        """Yield pages of API-shaped rows aggregated over the requested date range"""
+        dimensions = request_body.get('dimensions') or []
+        n = len(dimensions)
+        filters = _request_filters(request_body)
+
+        # Position is averaged weighted by impressions, as Search Console does
+        query = (
+            f'SELECT {"".join(d + ", " for d in dimensions)}SUM(clicks), SUM(impressions), '
+            'SUM(position * impressions) / SUM(impressions) FROM rows '
+            'WHERE site_url = ? AND search_type = ? AND dimension_set = ? AND date BETWEEN ? AND ?')
+        if dimensions:
+            query += f' GROUP BY {", ".join(dimensions)}'
+        # Match the API, which returns rows by clicks descending
+        query += f' ORDER BY {n + 1} DESC'
+        # Filtered rows are only counted once the filters have run
+        if max_rows is not None and not filters:
+            query += f' LIMIT {int(max_rows)}'
+
+        with self._lock, _span('store'):
+            cursor = self._connection().execute(query, (
+                site_url, request_body.get('searchType', 'web'), self.dimension_set(dimensions),
+                request_body['startDate'], request_body['endDate']))
+
+        while True:
+            with self._lock, _span('store'):
+                records = cursor.fetchmany(API_MAX_ROWS)
+            if not records:
+                break
+            # Aggregating no rows without GROUP BY still returns a row of NULLs
+            records = [record for record in records if record[n + 1]]
+            if filters:
+                records = _filter_records(records, dimensions, filters)
+                if max_rows is not None:
+                    records = records[:max_rows]
+                    max_rows -= len(records)
+            if records:
+                yield [
+                    {
+                        'keys': list(record[:n]),
+                        'clicks': record[n],
+                        'impressions': record[n + 1],
+                        'ctr': record[n] / record[n + 1],
+                        'position': record[n + 2]
+                    }
+                    for record in records
+                ]
+            if max_rows == 0:
+                break
+
+
+_warehouse = _Warehouse(os.path.join(DATA_DIR, 'warehouse.sqlite3'))
+
+
+class _RollupCube:
+    """
+    Local rollups of daily totals per site and search type, by device and country.
+
+    Each day is stored for every slice of device and country it is known for,
+    with '' standing for all devices or all countries, as sums of clicks,
+    impressions and position weighted by impressions. Weeks and months are
+    kept summed from their days and recomputed whenever one of their days
+    changes, so a trend over any range is read from a few indexed rows.
+    """
+
+    GRAINS = ['week', 'month']
+
+    def __init__(self, path):
+        # path None keeps the cube in memory, for calls that must not touch the stored one
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connection(self):
+        if self._conn is None:
+            if self.path:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path or ':memory:', check_same_thread=False, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS days ('
+                'site_url TEXT NOT NULL, search_type TEXT NOT NULL, device TEXT NOT NULL, country TEXT NOT NULL, '
+                'date TEXT NOT NULL, clicks REAL NOT NULL, impressions REAL NOT NULL, '
+                'weighted_position REAL NOT NULL, final INTEGER NOT NULL, synced_at REAL NOT NULL, '
+                'PRIMARY KEY (site_url, search_type, device, country, date))')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS periods ('
+                'site_url TEXT NOT NULL, search_type TEXT NOT NULL, device TEXT NOT NULL, country TEXT NOT NULL, '
+                'grain TEXT NOT NULL, period TEXT NOT NULL, clicks REAL NOT NULL, impressions REAL NOT NULL, '
+                'weighted_position REAL NOT NULL, '
+                'PRIMARY KEY (site_url, search_type, device, country, grain, period))')
+            self._conn = conn
+        return self._conn
+
+    def close(self):
+        """Close the database connection; it is reopened on next use"""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    @staticmethod
+    def period_start(day, grain):
+        """Return the first day of the week (starting Monday) or month containing day"""
+        date = datetime.date.fromisoformat(day)
+        if grain == 'week':
+            date -= datetime.timedelta(days=date.weekday())
+        elif grain == 'month':
+            date = date.replace(day=1)
+        return date.isoformat()
+
+    @staticmethod
+    def period_end(start, grain):
+        """Return the last day of the week or month starting on start"""
+        date = datetime.date.fromisoformat(start)
+        if grain == 'week':
+            date += datetime.timedelta(days=6)
+        elif grain == 'month':
+            date = (date.replace(day=28) + datetime.timedelta(days=4)).replace(day=1) - datetime.timedelta(days=1)
+        return date.isoformat()
+
+    def current_days(self, site_url, search_type, device, country, start_date, end_date):
+        """Return the days in range whose slice is final or was stored recently"""
+        fresh_after = time.time() - RECENT_DATA_TTL.total_seconds()
+        with self._lock:
+            cursor = self._connection().execute(
+                'SELECT date FROM days WHERE site_url = ? AND search_type = ? AND device = ? AND country = ? '
+                'AND date BETWEEN ? AND ? AND (final = 1 OR synced_at > ?)',
+                (site_url, search_type, device, country, start_date, end_date, fresh_after))
+            return {row[0] for row in cursor}
+
+    def store_slice(self, site_url, search_type, device, country, start_date, end_date, daily):
+        """Replace one slice's days in range with daily (date, clicks, impressions, weighted position) sums"""
+        sums = {day: (0.0, 0.0, 0.0) for day in _Warehouse._days(start_date, end_date)}
+        for date, clicks, impressions, weighted_position in daily:
+            sums[date] = (clicks, impressions, weighted_position)
+
+        with self._lock:
+            conn = self._connection()
+            conn.execute('BEGIN')
+            conn.execute(
+                'DELETE FROM days WHERE site_url = ? AND search_type = ? AND device = ? AND country = ? '
+                'AND date BETWEEN ? AND ?', (site_url, search_type, device, country, start_date, end_date))
+            self._insert_days(conn, site_url, search_type, {
+                (date, device, country): values for date, values in sums.items()})
+            self._update_periods(conn, site_url, search_type, start_date, end_date, (device, country))
+            conn.execute('COMMIT')
+
+    def store_synced(self, site_url, search_type, dimension_set, start_date, end_date, records):
+        """
+        Replace the days in range with the rows of a store sync.
+
+        records are (date, device, country, clicks, impressions, weighted
+        position) sums for a dimension set of device, country or both; every
+        slice they determine is stored, down to the all-devices, all-countries
+        totals.
+        """
+        dimensions = dimension_set.split(',') if dimension_set else []
+        slice_kinds = [(by_device, by_country)
+                       for by_device in ([True, False] if 'device' in dimensions else [False])
+                       for by_country in ([True, False] if 'country' in dimensions else [False])]
+
+        sums = {}
+        for date, device, country, clicks, impressions, weighted_position in records:
+            for by_device, by_country in slice_kinds:
+                entry = sums.setdefault(
+                    (date, device if by_device else '', country if by_country else ''), [0.0, 0.0, 0.0])
+                entry[0] += clicks
+                entry[1] += impressions
+                entry[2] += weighted_position
+
+        # Days without data for a slice seen in the range, and for the totals, count as stored with zeros
+        slices = {(device, country) for _, device, country in sums} | {('', '')}
+        for day in _Warehouse._days(start_date, end_date):
+            for device, country in slices:
+                sums.setdefault((day, device, country), [0.0, 0.0, 0.0])
+
+        with self._lock:
+            conn = self._connection()
+            conn.execute('BEGIN')
+            for by_device, by_country in slice_kinds:
+                conn.execute(
+                    "DELETE FROM days WHERE site_url = ? AND search_type = ? AND (device != '') = ? "
+                    "AND (country != '') = ? AND date BETWEEN ? AND ?",
+                    (site_url, search_type, by_device, by_country, start_date, end_date))
+            self._insert_days(conn, site_url, search_type, sums)
+            self._update_periods(conn, site_url, search_type, start_date, end_date)
+            conn.execute('COMMIT')
+
+    @staticmethod
+    def _insert_days(conn, site_url, search_type, sums):
+        synced_at = time.time()
+        conn.executemany('INSERT INTO days VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', [
+            (site_url, search_type, device, country, date, clicks, impressions, weighted_position,
+             int(_data_is_final(date)), synced_at)
+            for (date, device, country), (clicks, impressions, weighted_position) in sums.items()])
+
+    def _update_periods(self, conn, site_url, search_type, start_date, end_date, slice_key=None):
+        """Recompute the weeks and months overlapping a range from their days, for one slice or all"""
+        slice_sql = ' AND device = ? AND country = ?' if slice_key else ''
+        slice_args = tuple(slice_key or ())
+        for grain in self.GRAINS:
+            first = self.period_start(start_date, grain)
+            last = self.period_start(end_date, grain)
+            conn.execute(
+                f'DELETE FROM periods WHERE site_url = ? AND search_type = ? AND grain = ? '
+                f'AND period BETWEEN ? AND ?{slice_sql}', (site_url, search_type, grain, first, last) + slice_args)
+            period = first
+            while period <= last:
+                period_end = self.period_end(period, grain)
+                conn.execute(
+                    f'INSERT INTO periods SELECT site_url, search_type, device, country, ?, ?, '
+                    f'SUM(clicks), SUM(impressions), SUM(weighted_position) FROM days '
+                    f'WHERE site_url = ? AND search_type = ? AND date BETWEEN ? AND ?{slice_sql} '
+                    f'GROUP BY device, country',
+                    (grain, period, site_url, search_type, period, period_end) + slice_args)
+                period = _shift_day(period_end, 1)
+
+    def trend(self, site_url, search_type, device, country, start_date, end_date, interval):
+        """
+        Return (period start, clicks, impressions, weighted position) per day, week or month in range.
+
+        Weeks and months wholly inside the range are read from their rollups;
+        the partial ones at either end are summed from their days within the range.
+        """
+        key = (site_url, search_type, device, country)
+        with self._lock:
+            conn = self._connection()
+            if interval == 'day':
+                return conn.execute(
+                    'SELECT date, clicks, impressions, weighted_position FROM days WHERE site_url = ? '
+                    'AND search_type = ? AND device = ? AND country = ? AND date BETWEEN ? AND ? ORDER BY date',
+                    key + (start_date, end_date)).fetchall()
+
+            rows = []
+            whole = []
+            period = self.period_start(start_date, interval)
+            while period <= end_date:
+                period_end = self.period_end(period, interval)
+                if period >= start_date and period_end <= end_date:
+                    whole.append(period)
+                else:
+                    rows.append(conn.execute(
+                        'SELECT ?, SUM(clicks), SUM(impressions), SUM(weighted_position) FROM days '
+                        'WHERE site_url = ? AND search_type = ? AND device = ? AND country = ? '
+                        'AND date BETWEEN ? AND ?',
+                        (period,) + key + (max(period, start_date), min(period_end, end_date))).fetchone())
+                period = _shift_day(period_end, 1)
+
+            if whole:
+                rows += conn.execute(
+                    'SELECT period, clicks, impressions, weighted_position FROM periods WHERE site_url = ? '
+                    'AND search_type = ? AND device = ? AND country = ? AND grain = ? AND period BETWEEN ? AND ?',
+                    key + (interval, whole[0], whole[-1])).fetchall()
+        return sorted(row for row in rows if row[2])
+
+    def totals(self, site_url, search_type, device, country, start_date, end_date):
+        """Return (clicks, impressions, weighted position) summed over a range"""
+        with self._lock:
+            sums = self._connection().execute(
+                'SELECT SUM(clicks), SUM(impressions), SUM(weighted_position) FROM days WHERE site_url = ? '
+                'AND search_type = ? AND device = ? AND country = ? AND date BETWEEN ? AND ?',
+                (site_url, search_type, device, country, start_date, end_date)).fetchone()
+        return tuple(value or 0.0 for value in sums)
+
+
+_rollups = _RollupCube(os.path.join(DATA_DIR, 'rollups.sqlite3'))
+
+
+class _CacheWarmer:
+    """
+    Background thread that keeps configured queries warm in the cache.
+
+    Every interval it runs each configured query for each configured site
+    through the same path as the tool it stands for, at background priority,
+    so the tools' next calls are answered locally. Queries cover the last
+    days days up to lag_days ago, so they follow the calendar. Warming waits
+    while tool calls are running in this process.
+
+    Only one server process warms at a time; the others retry its lock each
+    interval, so one of them takes over once it exits. When each site was last
+    warmed is recorded in a status file every process can read.
+    """
+
+    TOOLS = ['query_search_analytics', 'get_search_trends']
+
+    def __init__(self, config_path, status_path):
+        self.config_path = config_path
+        self.status_path = status_path
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._lock_file = None
+
+    def load_config(self):
+        """Read the config file, filling in defaults; raises ValueError if it is invalid"""
+        with open(self.config_path) as f:
+            config = json.load(f)
+        if not isinstance(config, dict):
+            raise ValueError("the config must be a JSON object")
+
+        interval = config.get('interval_minutes', 15)
+        if isinstance(interval, bool) or not isinstance(interval, (int, float)) or interval <= 0:
+            raise ValueError("interval_minutes must be a positive number")
+
+        sites = config.get('sites')
+        if sites is not None and (not isinstance(sites, list)
+                                  or not all(isinstance(site, str) and site for site in sites)):
+            raise ValueError("sites must be a list of site URLs")
+
+        queries = config.get('queries')
+        if queries is not None and not isinstance(queries, list):
+            raise ValueError("queries must be a list of objects")
+
+        valid_dimensions = ['query', 'page', 'country', 'device', 'date']
+        valid_search_types = ['web', 'image', 'video', 'news', 'discover', 'googleNews']
+        checked = []
+        for query in queries or WARM_QUERIES:
+            if not isinstance(query, dict):
+                raise ValueError(f"each query must be an object, not {json.dumps(query)}")
+            query = dict({'tool': 'query_search_analytics', 'days': 28, 'lag_days': 1, 'dimensions': [],
+                          'search_type': 'web', 'row_limit': 1000}, **query)
+            if query['tool'] not in self.TOOLS:
+                raise ValueError(f"invalid tool {query['tool']}; valid tools are: {', '.join(self.TOOLS)}")
+            for field, minimum in [('days', 1), ('lag_days', 0), ('row_limit', 1)]:
+                if isinstance(query[field], bool) or not isinstance(query[field], int) or query[field] < minimum:
+                    raise ValueError(f"{field} must be an integer of at least {minimum}")
+            if not isinstance(query['dimensions'], list) or not all(
+                    dim in valid_dimensions for dim in query['dimensions']):
+                raise ValueError(f"dimensions must be a list of: {', '.join(valid_dimensions)}")
+            if query['search_type'] not in valid_search_types:
+                raise ValueError(f"invalid search_type {query['search_type']}; "
+                                 f"valid types are: {', '.join(valid_search_types)}")
+            checked.append(query)
+
+        return {
+            'interval': float(interval) * 60,
+            'sites': sites,
+            'queries': checked,
+        }
+
+    def start(self):
+        """Start warming on a background thread"""
+        threading.Thread(target=self._run, name='gsc-warmer', daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _take_lock(self):
+        """Hold an exclusive lock on a file next to the status file for the life of the process"""
+        if self._lock_file is not None:
+            return True
+        try:
+            import fcntl
+        except ImportError:
+            # No file locks (Windows); every process warms
+            return True
+        os.makedirs(os.path.dirname(self.status_path), exist_ok=True)
+        lock_file = open(self.status_path + '.lock', 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def _run(self):
+        while not self._stop.is_set():
+            started = time.monotonic()
+            interval = 15 * 60
+            try:
+                # Read the config each round, so edits apply without a restart
+                config = self.load_config()
+                interval = config['interval']
+                # Another process holding the lock is warming; try again next round
+                if self._take_lock():
+                    self.warm(config)
+            except Exception as e:
+                logger.warning("Cache warming failed: %s", e)
+            self._stop.wait(max(0.0, interval - (time.monotonic() - started)))
+
+    def warm(self, config):
+        """Run every configured query for every configured site once"""
+        sites = config['sites']
+        if not sites:
+            sites_list = _execute_api(_client.service().sites().list(), priority=PRIORITY_BACKGROUND)
+            sites = [site['siteUrl'] for site in sites_list.get('siteEntry', [])]
+
+        for site_url in sites:
+            failed = 0
+            fresh_until = None
+            for query in config['queries']:
+                if self._stop.is_set():
+                    return
+                try:
+                    end_date = self._warm_query(site_url, query)
+                except Exception as e:
+                    failed += 1
+                    logger.warning("Warming %s for %s failed: %s", query, site_url, e)
+                    continue
+                # Responses touching recent days expire, so the site only stays warm until then
+                if not _data_is_final(end_date):
+                    expires = time.time() + RECENT_DATA_TTL.total_seconds()
+                    fresh_until = expires if fresh_until is None else min(fresh_until, expires)
+            self._record(site_url, {
+                'warmed_at': time.time(),
+                'date': datetime.date.today().isoformat(),
+                'queries': len(config['queries']),
+                'failed': failed,
+                'fresh_until': fresh_until,
+            })
+
+    def _warm_query(self, site_url, query):
+        """Fetch one configured query the way its tool does; returns its end date"""
+        end = datetime.date.today() - datetime.timedelta(days=query['lag_days'])
+        start_date = (end - datetime.timedelta(days=query['days'] - 1)).isoformat()
+        end_date = end.isoformat()
+
+        self._wait_for_interactive()
+        if query['tool'] == 'get_search_trends':
+            # Refetch the days that can still change, then fill in any final days the cube is missing
+            recent = max(start_date, (datetime.date.today() - datetime.timedelta(
+                days=DATA_FINALIZATION_DAYS)).isoformat())
+            if recent <= end_date:
+                _fill_rollups(_rollups, site_url, query['search_type'], '', '', recent, end_date, 'refresh',
+                              PRIORITY_BACKGROUND)
+            _fill_rollups(_rollups, site_url, query['search_type'], '', '', start_date, end_date, 'use',
+                          PRIORITY_BACKGROUND)
+            return end_date
+
+        # The same request body query_search_analytics builds, so its calls hit the cached pages.
+        # Responses that include recent days are refetched every round, before they expire.
+        request_body = {
+            'startDate': start_date,
+            'endDate': end_date,
+            'dimensions': query['dimensions'],
+            'searchType': query['search_type']
+        }
+        cache = 'use' if _data_is_final(end_date) else 'refresh'
+        for _ in _iter_query_pages(site_url, request_body, query['row_limit'], cache, PRIORITY_BACKGROUND):
+            self._wait_for_interactive()
+        return end_date
+
+    def _wait_for_interactive(self):
+        """Pause while tool calls are running or interactive requests are waiting for the API"""
+        while ((_metrics.active_calls() or _scheduler.stats()['interactive_queued'])
+               and not self._stop.is_set()):
+            self._stop.wait(0.5)
+
+    def _record(self, site_url, entry):
+        with self._lock:
+            status = self.status()
+            status[site_url] = entry
+            os.makedirs(os.path.dirname(self.status_path), exist_ok=True)
+            with open(self.status_path + '.tmp', 'w') as f:
+                json.dump(status, f)
+            os.replace(self.status_path + '.tmp', self.status_path)
+
+    def status(self):
+        """Return the last warming of each site, by site URL"""
+        try:
+            with open(self.status_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def is_warm(entry):
+        """Return whether every query of a site's last warming succeeded today and is still cached"""
+        if not entry or entry['failed'] or entry['date'] != datetime.date.today().isoformat():
+            return False
+        return entry['fresh_until'] is None or entry['fresh_until'] > time.time()
+
+
+_warmer = _CacheWarmer(WARM_CONFIG, os.path.join(DATA_DIR, 'warm_status.json'))
+
+_prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix='gsc-prefetch')
+
+# Kept separate from the prefetch pool: queries on this pool wait on prefetched
+# pages, so sharing one pool could leave every worker waiting on queued work
+_query_executor = ThreadPoolExecutor(max_workers=QUERY_WORKERS, thread_name_prefix='gsc-query')
+
+# Tool bodies run here; its size is the limit on concurrent tool calls
+_tool_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_CALLS, thread_name_prefix='gsc-tool')
+
+# Per-site queries of query_multiple_sites; a pool of its own so a large fan-out
+# can't take every query or tool worker
+_site_executor = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix='gsc-site')
+
+# Per-day or per-week sub-queries of chunked queries, which may themselves run
+# on the query pool (compare_time_periods)
+_chunk_executor = ThreadPoolExecutor(max_workers=CHUNK_WORKERS, thread_name_prefix='gsc-chunk')
+
+# Event loop of the tool call running on the current thread, used to send
+# notifications back to the client from the tool executor
+_tool_loop = contextvars.ContextVar('gsc_tool_loop', default=None)
+
+
+def _async_tool(fn):
+    """
+    Turn a blocking tool function into an async one that runs on the tool executor.
+
+    API calls and pandas work then happen off the event loop, so a slow call
+    does not hold up other requests to the server. The call's phase timings
+    are collected in its context and counted in the metrics.
+    
+    When the client cancels the call, the awaiting task is cancelled, but the
+    executor thread keeps going; the call's _CallProgress is cancelled too, so
+    its threads stop at their next check instead of spending more quota.
+    """
+    signature = inspect.signature(fn)
+    
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        call = _CallTimings(fn.__name__)
+        progress = _CallProgress(signature.bind_partial(*args, **kwargs).arguments.get('ctx'), loop)
+        submitted = time.perf_counter()
+        
+        def run():
+            _record('queued', time.perf_counter() - submitted)
+            with _span('tool'):
+                result = fn(*args, **kwargs)
+            
+            _metrics.count('tool_calls')
+            if progress.cancelled.is_set():
+                _metrics.count('cancelled_calls')
+            elif isinstance(result, str) and result.startswith("Error"):
+                _metrics.count('tool_errors')
+            if DEBUG_TIMINGS and isinstance(result, str):
+                result += "\n\n" + call.summary()
+            return result
+        
+        context = contextvars.copy_context()
+        context.run(_tool_loop.set, loop)
+        context.run(_current_call.set, call)
+        context.run(_current_progress.set, progress)
+        
+        # Counted until the call's thread is done with it, or it's cancelled before it starts;
+        # the cache warmer pauses while any call is counted
+        _metrics.call_started()
+        future = _tool_executor.submit(context.run, run)
+        future.add_done_callback(lambda _: _metrics.call_finished())
+        try:
+            result = await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            progress.cancel()
+            raise
+        finally:
+            sending = progress.finish()
+        
+        # Progress still being sent must arrive before the result
+        if sending is not None:
+            await asyncio.wrap_future(sending)
+        return result
+
+    return wrapper
+
+
+def _notify(ctx, message):
+    """Send an info message to the client from a tool running on the tool executor"""
+    loop = _tool_loop.get()
+    if ctx is None or loop is None:
+        return
+    
+    # Don't wait for delivery; the tool keeps working while the message is sent
+    asyncio.run_coroutine_threadsafe(ctx.info(message), loop)
+
+
+def _execute_query(site_url, request_body, cache='use', priority=PRIORITY_INTERACTIVE):
+    """
+    Run a single Search Analytics request through the response cache.
+
+    cache is one of CACHE_MODES: 'use' reads and writes the cache, 'refresh'
+    skips the read but replaces the cached entry, 'bypass' leaves it untouched.
+    """
+    _check_cancelled()
+    if cache == 'use':
+        with _span('cache'):
+            response = _cache.get(site_url, request_body)
+        if response is not None:
+            _metrics.count('cache_hits')
+            return response
+        _metrics.count('cache_misses')
+
+    # Identical queries already in flight share that upstream call; only 'use'
+    # callers may share one answered from cached overlapping ranges
+    key = (_cache.key(site_url, request_body), cache == 'use')
+    return _in_flight.run(key, lambda: _fetch_response(site_url, request_body, cache, priority))
+
+def _fetch_response(site_url, request_body, cache, priority):
+    """Fetch a response that isn't cached, from overlapping cached ranges or the API, and cache it"""
+    response = expires_at = None
+    if cache == 'use':
+        response, expires_at = _execute_overlapping(site_url, request_body, priority) or (None, None)
+
+    if response is None:
+        response = _execute_api(
+            _client.service().searchanalytics().query(siteUrl=site_url, body=request_body),
+            site_url, priority)
+        _metrics.count('rows_received', len(response.get('rows', [])))
+
+    if cache != 'bypass':
+        with _span('cache'):
+            _cache.put(site_url, request_body, response, expires_at)
+
+    return response
+
+def _execute_overlapping(site_url, request_body, priority):
+    """
+    Answer a query grouped by date from a cached response for an overlapping
+    date range, fetching only the days before or after it.
+
+    Returns (response, expires_at), where expires_at is the earliest expiry
+    of the responses it was built from (None if none of them expire), so rows
+    aren't served from the cache after their own entry would have expired.
+    Returns None when no cached range overlaps, or when a result would not
+    fit in one page, since pages are only consistent when they come from a
+    single response.
+    """
+    dimensions = request_body.get('dimensions') or []
+    if 'date' not in dimensions or request_body.get('startRow'):
+        return None
+
+    with _span('cache'):
+        cached = _cache.overlapping(site_url, request_body)
+    if cached is None:
+        return None
+
+    cached_start, cached_end, response, cached_expires_at = cached
+    expiries = [cached_expires_at]
+    start_date, end_date = request_body['startDate'], request_body['endDate']
+    row_limit = request_body.get('rowLimit', 1000)
+    date_index = dimensions.index('date')
+    rows = [row for row in response.get('rows', []) if start_date <= row['keys'][date_index] <= end_date]
+    if len(rows) >= row_limit:
+        return None
+
+    # Fetch the days on either side of the cached range
+    missing = []
+    if start_date < cached_start:
+        missing.append((start_date, _shift_day(cached_start, -1)))
+    if cached_end < end_date:
+        missing.append((_shift_day(cached_end, 1), end_date))
+    for missing_start, missing_end in missing:
+        part_body = dict(request_body, startDate=missing_start, endDate=missing_end)
+        part = _execute_query(site_url, part_body, 'use', priority)
+        rows.extend(part.get('rows', []))
+        expiries.append(_cache.expiry(site_url, part_body))
+
+    if len(rows) >= row_limit:
+        return None
+
+    # The API sorts rows grouped by date by date
+    rows.sort(key=lambda row: (row['keys'][date_index], -row.get('clicks', 0)))
+    _metrics.count('partial_cache_hits')
+    expiries = [expiry for expiry in expiries if expiry is not None]
+    stitched = {'rows': rows, 'responseAggregationType': response.get('responseAggregationType', 'auto')} if rows else {}
+    return stitched, min(expiries, default=None)
+
+def _shift_day(day, days):
+    """Return the YYYY-MM-DD date the given number of days from day"""
+    return (datetime.date.fromisoformat(day) + datetime.timedelta(days=days)).isoformat()
+
+def _iter_query_pages(site_url, request_body, max_rows=None, cache='use', priority=PRIORITY_INTERACTIVE):
+    """Yield result pages from the local store when it covers the request, otherwise from the API"""
+    if cache == 'use' and _warehouse.covers(site_url, request_body):
+        return _report_pages(_warehouse.iter_pages(site_url, request_body, max_rows))
+    return _iter_pages(site_url, request_body, max_rows, cache, priority)
+
+def _report_pages(pages):
+    """Count pages from the local store towards the current call's progress"""
+    progress = _current_progress.get()
+    if progress is not None:
+        progress.query_started()
+    for rows in pages:
+        _check_cancelled()
+        if progress is not None:
+            progress.page_fetched(len(rows), False)
+        yield rows
+
+def _iter_pages(site_url, request_body, max_rows=None, cache='use', priority=PRIORITY_INTERACTIVE, start_row=0):
+    """
+    Yield pages of Search Analytics rows from start_row, following startRow
+    until the API runs out of rows or max_rows rows have been returned.
+
+    The next page is requested before the current one is yielded, so the
+    network round-trip overlaps with whatever the caller does with the page.
+    Each page is reported to the current call's progress, and a cancelled
+    call stops before requesting another.
+    """
+    progress = _current_progress.get()
+    if progress is not None:
+        progress.query_started()
+    
+    def fetch_page(start_row):
+        page_size = API_MAX_ROWS if max_rows is None else min(API_MAX_ROWS, max_rows - start_row)
+        body = dict(request_body, startRow=start_row, rowLimit=page_size)
+        response = _execute_query(site_url, body, cache, priority)
+        return response.get('rows', []), page_size
+
+    next_page = _submit(_prefetch_executor, fetch_page, start_row)
+    try:
+        while next_page is not None:
+            rows, page_size = next_page.result()
+            start_row += len(rows)
+
+            # A short page means the API has no more rows
+            _check_cancelled()
+            if len(rows) == page_size and (max_rows is None or start_row < max_rows):
+                next_page = _submit(_prefetch_executor, fetch_page, start_row)
+            else:
+                next_page = None
+
+            if progress is not None:
+                progress.page_fetched(len(rows), next_page is not None)
+            if rows:
+                yield rows
+    finally:
+        # The caller stopped early, so the prefetched page is not needed
+        if next_page is not None:
+            next_page.cancel()
 
 @mcp.tool()
-def list_sites(ctx: Context) -> str:
-    """List all verified sites in Search Console."""
+@_async_tool
+def list_sites(ctx: Context, output_format: str = "table") -> str:
+    """
+    List all verified sites in Search Console.
+    
+    When the cache warmer is configured, each site also shows whether its
+    configured queries are warm in the cache and when they were last warmed.
+    
+    Args:
+        output_format: Output format: table (default), csv, jsonl or columnar-json
+    """
     try:
-        # Get credentials file path from environment variable
-        credentials_file = os.environ.get('GOOGLE_APPLICATION_CREDENTIALS')
-        
-        if not credentials_file:
-            return "Error: GOOGLE_APPLICATION_CREDENTIALS environment variable not set"
-            
-        if not os.path.exists(credentials_file):
-            return f"Error: Credentials file not found at {credentials_file}"
+        # Validate output_format
+        if output_format not in OUTPUT_FORMATS:
+            return f"Invalid output_format: {output_format}. Valid formats are: {', '.join(OUTPUT_FORMATS)}"
         
-        # Authenticate using service account credentials
-        credentials = service_account.Credentials.from_service_account_file(
-            credentials_file, scopes=SCOPES)
-            
-        # Set up the Search Console API service
-        service = build('webmasters', 'v3', credentials=credentials)
+        # Get the shared Search Console API service
+        service = _client.service()
         
         # Get the list of verified sites
-        sites_list = service.sites().list().execute()
+        sites_list = _execute_api(service.sites().list())
         sites = [site['siteUrl'] for site in sites_list.get('siteEntry', [])]
         
         if not sites:
             return "No verified sites found."
         
-        return "\n".join([f"- {site}" for site in sites])
+        # Show which sites the cache warmer keeps warm
+        lines = [f"- {site}" for site in sites]
+        columns = {'site_url': sites}
+        if WARM_CONFIG:
+            status = _warmer.status()
+            columns['warm'] = [_CacheWarmer.is_warm(status.get(site)) for site in sites]
+            columns['warmed_at'] = [
+                datetime.datetime.fromtimestamp(status[site]['warmed_at']).isoformat(timespec='seconds')
+                if site in status else None for site in sites]
+            for i, site in enumerate(sites):
+                entry = status.get(site)
+                if entry is None:
+                    lines[i] += " (not warmed yet)"
+                    continue
+                minutes = int((time.time() - entry['warmed_at']) // 60)
+                state = "warm" if columns['warm'][i] else "cold"
+                failed = f", {entry['failed']} of {entry['queries']} queries failed" if entry['failed'] else ""
+                lines[i] += f" ({state}, warmed {minutes} min ago{failed})"
+        
+        # The table is built without pandas, so the first call of most sessions doesn't wait for it to import
+        df = None if output_format == 'table' else pd.DataFrame(columns)
+        return _render_output(df, output_format, lambda: ([], lines), totals={})
         
     except Exception as e:
         return f"Error: {str(e)}"
 
 @mcp.tool()
+@_async_tool
 def query_search_analytics(
     site_url: str, 
     start_date: str, 
@@ -55,7 +2019,11 @@ def query_search_analytics(
     ctx: Context,
     dimensions: list = None,
     search_type: str = "web",
-    row_limit: int = 1000
+    filters: list = None,
+    row_limit: int = 1000,
+    chunk_by: str = "none",
+    cache: str = "use",
+    output_format: str = "table"
 ) -> str:
     """
     Query Search Console analytics data for a site.
@@ -66,25 +2034,17 @@ def query_search_analytics(
         end_date: End date in YYYY-MM-DD format
         dimensions: List of dimensions (query, page, device, country, date)
         search_type: Type of search results (web, image, video, news, discover, googleNews)
-        row_limit: Number of rows to return (max 25000)
+        filters: Dimension filters applied by the API; rows must match all of them. Each is an object
+            with dimension (query, page, country, device), operator (equals, notEquals, contains,
+            notContains, includingRegex, excludingRegex; default equals) and expression
+            (e.g. {"dimension": "page", "operator": "contains", "expression": "/blog/"})
+        row_limit: Maximum number of rows to return (paged past the API's 25000-row limit)
+        chunk_by: Split the date range into sub-queries run in parallel and merged: none (default),
+            day or week. Returns many more distinct rows for query and page over long ranges.
+        cache: Cache mode: use (default; also answers from data synced with sync_site), refresh (ignore and replace cached responses) or bypass
+        output_format: Output format: table (default), csv, jsonl or columnar-json
     """
     try:
-        # Get credentials file path from environment variable
-        credentials_file = os.environ.get('GOOGLE_APPLICATION_CREDENTIALS')
-        
-        if not credentials_file:
-            return "Error: GOOGLE_APPLICATION_CREDENTIALS environment variable not set"
-            
-        if not os.path.exists(credentials_file):
-            return f"Error: Credentials file not found at {credentials_file}"
-        
-        # Authenticate using service account credentials
-        credentials = service_account.Credentials.from_service_account_file(
-            credentials_file, scopes=SCOPES)
-            
-        # Set up the Search Console API service
-        service = build('webmasters', 'v3', credentials=credentials)
-        
         # Validate inputs
         valid_dimensions = ['query', 'page', 'country', 'device', 'date']
         if dimensions:
@@ -93,70 +2053,77 @@ def query_search_analytics(
                     return f"Invalid dimension: {dim}. Valid dimensions are: {', '.join(valid_dimensions)}"
         
         # Validate row_limit
-        if row_limit < 1 or row_limit > 25000:
-            return "row_limit must be between 1 and 25000"
+        if row_limit < 1:
+            return "row_limit must be at least 1"
             
         # Validate search_type
         valid_search_types = ['web', 'image', 'video', 'news', 'discover', 'googleNews']
         if search_type not in valid_search_types:
             return f"Invalid search_type: {search_type}. Valid types are: {', '.join(valid_search_types)}"
         
+        # Validate filters
+        filter_error = _validate_filters(filters)
+        if filter_error:
+            return filter_error
+        
+        # Validate chunk_by
+        if chunk_by not in CHUNK_DAYS:
+            return f"Invalid chunk_by: {chunk_by}. Valid values are: {', '.join(CHUNK_DAYS)}"
+        
+        # Validate cache
+        if cache not in CACHE_MODES:
+            return f"Invalid cache: {cache}. Valid values are: {', '.join(CACHE_MODES)}"
+        
+        # Validate output_format
+        if output_format not in OUTPUT_FORMATS:
+            return f"Invalid output_format: {output_format}. Valid formats are: {', '.join(OUTPUT_FORMATS)}"
+        
         # Build the request body
         request_body = {
             'startDate': start_date,
             'endDate': end_date,
             'dimensions': dimensions or [],
-            'searchType': search_type,
-            'rowLimit': row_limit
+            'searchType': search_type
         }
+        if filters:
+            request_body['dimensionFilterGroups'] = _filter_groups(filters)
         
-        # Execute the search analytics query
-        response = service.searchanalytics().query(siteUrl=site_url, body=request_body).execute()
+        # Fetch every page of rows as a DataFrame
+        df = _fetch_chunked_dataframe(site_url, request_body, dimensions, chunk_by, row_limit, cache)
         
-        # Process and format the results
-        if 'rows' not in response or not response['rows']:
+        if df.empty:
             return "No data found for the specified parameters."
         
-        rows = response['rows']
-        
-        # Format the output based on dimensions
-        result = []
-        headers = []
-        
-        # Add dimension headers
-        if dimensions:
-            headers.extend(dimensions)
-        
-        # Add metric headers
-        headers.extend(['clicks', 'impressions', 'ctr', 'position'])
-        
-        # Add headers to result
-        result.append(" | ".join(headers))
-        result.append("-" * (sum(len(h) for h in headers) + 3 * len(headers)))
-        
-        # Add data rows
-        for row in rows:
-            row_data = []
+        def table():
+            # Format the output based on dimensions
+            headers = []
             
-            # Add dimension values
+            # Add dimension headers
             if dimensions:
-                for i, dim_value in enumerate(row.get('keys', [])):
-                    row_data.append(dim_value)
+                headers.extend(dimensions)
+            
+            # Add metric headers
+            headers.extend(['clicks', 'impressions', 'ctr', 'position'])
+            
+            # Add dimension values, formatting a column at a time
+            columns = [_format_text(df[dim]) for dim in dimensions or []]
             
             # Add metric values
-            row_data.append(str(row.get('clicks', 0)))
-            row_data.append(str(row.get('impressions', 0)))
-            row_data.append(f"{row.get('ctr', 0) * 100:.2f}%")
-            row_data.append(f"{row.get('position', 0):.2f}")
+            columns.append(_format_column(df['clicks'], '{:.0f}'))
+            columns.append(_format_column(df['impressions'], '{:.0f}'))
+            columns.append(_format_column(df['ctr'] * 100, '{:.2f}%'))
+            columns.append(_format_column(df['position'], '{:.2f}'))
             
-            result.append(" | ".join(row_data))
+            header_lines = [" | ".join(headers), "-" * (sum(len(h) for h in headers) + 3 * len(headers))]
+            return header_lines, _join_columns(columns)
         
-        return "\n".join(result)
+        return _render_output(df, output_format, table)
         
     except Exception as e:
         return f"Error: {str(e)}"
 
 @mcp.tool()
+@_async_tool
 def compare_time_periods(
     site_url: str,
     current_start_date: str,
@@ -166,10 +2133,15 @@ def compare_time_periods(
     ctx: Context,
     dimensions: list = None,
     search_type: str = "web",
-    row_limit: int = 1000
+    filters: list = None,
+    row_limit: int = 1000,
+    additional_periods: list = None,
+    chunk_by: str = "none",
+    cache: str = "use",
+    output_format: str = "table"
 ) -> str:
     """
-    Compare Search Console metrics between two time periods.
+    Compare Search Console metrics between two or more time periods.
     
     Args:
         site_url: Full URL of your website (e.g., https://www.example.com/ or sc-domain:example.com)
@@ -179,25 +2151,20 @@ def compare_time_periods(
         previous_end_date: End date for previous period in YYYY-MM-DD format
         dimensions: List of dimensions (query, page, device, country, date)
         search_type: Type of search results (web, image, video, news, discover, googleNews)
-        row_limit: Number of rows to return (max 25000)
+        filters: Dimension filters applied by the API; rows must match all of them. Each is an object
+            with dimension (query, page, country, device), operator (equals, notEquals, contains,
+            notContains, includingRegex, excludingRegex; default equals) and expression
+            (e.g. {"dimension": "page", "operator": "contains", "expression": "/blog/"})
+        row_limit: Maximum number of rows to return per period (paged past the API's 25000-row limit)
+        additional_periods: Extra periods to compare the current period against, e.g. for
+            week-over-week, month-over-month and year-over-year in one call. Each is an object
+            with start_date, end_date and an optional label (e.g. {"label": "yoy", "start_date": "2024-01-01", "end_date": "2024-01-31"})
+        chunk_by: Split each period into sub-queries run in parallel and merged: none (default),
+            day or week. Returns many more distinct rows for query and page over long ranges.
+        cache: Cache mode: use (default; also answers from data synced with sync_site), refresh (ignore and replace cached responses) or bypass
+        output_format: Output format: table (default), csv, jsonl or columnar-json
     """
     try:
-        # Get credentials file path from environment variable
-        credentials_file = os.environ.get('GOOGLE_APPLICATION_CREDENTIALS')
-        
-        if not credentials_file:
-            return "Error: GOOGLE_APPLICATION_CREDENTIALS environment variable not set"
-            
-        if not os.path.exists(credentials_file):
-            return f"Error: Credentials file not found at {credentials_file}"
-        
-        # Authenticate using service account credentials
-        credentials = service_account.Credentials.from_service_account_file(
-            credentials_file, scopes=SCOPES)
-            
-        # Set up the Search Console API service
-        service = build('webmasters', 'v3', credentials=credentials)
-        
         # Validate inputs
         valid_dimensions = ['query', 'page', 'country', 'device', 'date']
         if dimensions:
@@ -206,389 +2173,1538 @@ def compare_time_periods(
                     return f"Invalid dimension: {dim}. Valid dimensions are: {', '.join(valid_dimensions)}"
         
         # Validate row_limit
-        if row_limit < 1 or row_limit > 25000:
-            return "row_limit must be between 1 and 25000"
+        if row_limit < 1:
+            return "row_limit must be at least 1"
             
         # Validate search_type
         valid_search_types = ['web', 'image', 'video', 'news', 'discover', 'googleNews']
         if search_type not in valid_search_types:
             return f"Invalid search_type: {search_type}. Valid types are: {', '.join(valid_search_types)}"
         
-        # Build the request body for current period
-        current_request_body = {
-            'startDate': current_start_date,
-            'endDate': current_end_date,
-            'dimensions': dimensions or [],
-            'searchType': search_type,
-            'rowLimit': row_limit
-        }
+        # Validate filters
+        filter_error = _validate_filters(filters)
+        if filter_error:
+            return filter_error
+        
+        # Validate chunk_by
+        if chunk_by not in CHUNK_DAYS:
+            return f"Invalid chunk_by: {chunk_by}. Valid values are: {', '.join(CHUNK_DAYS)}"
+        
+        # Validate cache
+        if cache not in CACHE_MODES:
+            return f"Invalid cache: {cache}. Valid values are: {', '.join(CACHE_MODES)}"
+        
+        # Validate output_format
+        if output_format not in OUTPUT_FORMATS:
+            return f"Invalid output_format: {output_format}. Valid formats are: {', '.join(OUTPUT_FORMATS)}"
+        
+        # Validate additional periods and give each one a label for its columns
+        periods = [
+            ('current', current_start_date, current_end_date),
+            ('previous', previous_start_date, previous_end_date)
+        ]
+        for i, period in enumerate(additional_periods or [], start=len(periods) + 1):
+            if not isinstance(period, dict) or 'start_date' not in period or 'end_date' not in period:
+                return "Each additional period must be an object with start_date and end_date"
+            label = str(period.get('label') or f"period_{i}").replace(' ', '_')
+            if label in [p[0] for p in periods]:
+                return f"Duplicate period label: {label}"
+            periods.append((label, period['start_date'], period['end_date']))
+        
+        # Totals without dimensions come from the rollup cube when the filters select one of its slices
+        slice_key = _rollup_slice(filters) if not dimensions and cache != 'bypass' else None
+        if slice_key is not None:
+            # Filled on this thread like get_search_trends: _fill_rollups runs its queries on
+            # _query_executor, so running it there too could leave every worker waiting on queued work
+            for _, start_date, end_date in periods:
+                _fill_rollups(_rollups, site_url, search_type, *slice_key, start_date, end_date, cache)
+            with _span('store'):
+                period_sums = {
+                    label: _rollups.totals(site_url, search_type, *slice_key, start_date, end_date)
+                    for label, start_date, end_date in periods
+                }
+            if not any(sums[1] for sums in period_sums.values()):
+                return "No data found for the specified parameters in any period."
+        else:
+            # Fetch all periods concurrently; each one is an independent query
+            _plan_queries(len(periods))
+            futures = []
+            for label, start_date, end_date in periods:
+                request_body = {
+                    'startDate': start_date,
+                    'endDate': end_date,
+                    'dimensions': dimensions or [],
+                    'searchType': search_type
+                }
+                if filters:
+                    request_body['dimensionFilterGroups'] = _filter_groups(filters)
+                futures.append(_submit(
+                    _query_executor, _fetch_chunked_dataframe, site_url, request_body, dimensions, chunk_by,
+                    row_limit, cache))
+            
+            # The merge starts once every period has arrived
+            period_dfs = {period[0]: future.result() for period, future in zip(periods, futures)}
+            
+            # Process and format the results
+            if all(df.empty for df in period_dfs.values()):
+                return "No data found for the specified parameters in any period."
+            
+            if not dimensions:
+                period_sums = {
+                    label: (df['clicks'].sum(), df['impressions'].sum(), (df['position'] * df['impressions']).sum())
+                    for label, df in period_dfs.items()
+                }
         
-        # Build the request body for previous period
-        previous_request_body = {
-            'startDate': previous_start_date,
-            'endDate': previous_end_date,
-            'dimensions': dimensions or [],
-            'searchType': search_type,
-            'rowLimit': row_limit
+        metrics = ['clicks', 'impressions', 'ctr', 'position']
+        
+        with _span('merge'):
+            # Join all periods on dimensions in a single pass
+            if dimensions:
+                merged_df = _merge_periods(period_dfs, dimensions)
+            else:
+                # If no dimensions, create a single row DataFrame with totals; CTR and
+                # position are recomputed from the sums, weighting position by impressions
+                totals = {}
+                for label, (clicks, impressions, weighted_position) in period_sums.items():
+                    totals[f'clicks_{label}'] = [clicks]
+                    totals[f'impressions_{label}'] = [impressions]
+                    totals[f'ctr_{label}'] = [clicks / impressions if impressions else 0]
+                    totals[f'position_{label}'] = [weighted_position / impressions if impressions else 0]
+                merged_df = pd.DataFrame(totals)
+            
+            # Calculate changes against the previous period, then against any additional ones
+            comparisons = [('previous', '')] + [(label, f'_vs_{label}') for label, _, _ in periods[2:]]
+            for label, suffix in comparisons:
+                _add_period_changes(merged_df, label, suffix)
+        
+        # Format the output
+        result = []
+        
+        # Add period information
+        result.append(f"Comparison between:")
+        result.append(f"Current period: {current_start_date} to {current_end_date}")
+        result.append(f"Previous period: {previous_start_date} to {previous_end_date}")
+        for label, start_date, end_date in periods[2:]:
+            result.append(f"Comparison period ({label}): {start_date} to {end_date}")
+        result.append("")
+        
+        # Format the DataFrame as a string table
+        if dimensions:
+            # Select columns for display
+            display_cols = list(dimensions)
+            for metric in metrics:
+                change_cols = [f'{metric}_change'] if metric == 'position' else [f'{metric}_change', f'{metric}_change_pct']
+                for label, suffix in comparisons:
+                    if not suffix:
+                        display_cols += [f'{metric}_current', f'{metric}_previous']
+                    else:
+                        display_cols.append(f'{metric}_{label}')
+                    display_cols += [col + suffix for col in change_cols]
+            display_df = merged_df[display_cols].fillna({col: 0 for col in display_cols[len(dimensions):]})
+            
+            # Sort by current clicks (descending)
+            display_df = display_df.sort_values('clicks_current', ascending=False)
+            
+            def table():
+                # Format a column at a time, then pad each one to its widest cell:
+                # dimensions to the left, metrics to the right
+                columns = []
+                for col in display_df.columns:
+                    if col in dimensions:
+                        cells = _format_text(display_df[col])
+                        align = str.ljust
+                    else:
+                        if 'change_pct' in col:
+                            cells = _format_column(display_df[col], "{:.2f}%")
+                        elif col.startswith('ctr'):
+                            cells = _format_column(display_df[col] * 100, "{:.2f}%")
+                        elif col.startswith('position'):
+                            cells = _format_column(display_df[col], "{:.2f}")
+                        else:
+                            cells = _format_column(display_df[col], "{:.0f}")
+                        align = str.rjust
+                    width = max(len(col), max(map(len, cells), default=0))
+                    columns.append([align(col, width)] + [align(cell, width) for cell in cells])
+                
+                # The first line holds the column names
+                lines = _join_columns(columns)
+                return result + [lines[0], "-" * len(lines[0])], lines[1:]
+            
+            return _render_output(display_df, output_format, table)
+        
+        def table():
+            # For no dimensions, just show the totals
+            row = merged_df.iloc[0]
+            for label, suffix in comparisons:
+                result.append("Overall Metrics:" if not suffix else f"Overall Metrics vs {label}:")
+                result.append(f"Clicks: {row['clicks_current']:.0f} vs {row[f'clicks_{label}']:.0f} ({row['clicks_change' + suffix]:.0f}, {row['clicks_change_pct' + suffix]:.2f}%)")
+                result.append(f"Impressions: {row['impressions_current']:.0f} vs {row[f'impressions_{label}']:.0f} ({row['impressions_change' + suffix]:.0f}, {row['impressions_change_pct' + suffix]:.2f}%)")
+                result.append(f"CTR: {row['ctr_current']*100:.2f}% vs {row[f'ctr_{label}']*100:.2f}% ({row['ctr_change' + suffix]*100:.2f}%, {row['ctr_change_pct' + suffix]:.2f}%)")
+                result.append(f"Position: {row['position_current']:.2f} vs {row[f'position_{label}']:.2f} ({row['position_change' + suffix]:.2f})")
+            return result, []
+        
+        return _render_output(merged_df, output_format, table)
+        
+    except Exception as e:
+        return f"Error: {str(e)}"
+
+@mcp.tool()
+@_async_tool
+def get_top_performing_content(
+    site_url: str,
+    start_date: str,
+    end_date: str,
+    ctx: Context,
+    metric: str = "clicks",
+    limit: int = 10,
+    dimensions: list = None,
+    search_type: str = "web",
+    min_impressions: int = None,
+    cache: str = "use",
+    output_format: str = "table"
+) -> str:
+    """
+    Get the top performing content based on a specific metric.
+    
+    Args:
+        site_url: Full URL of your website (e.g., https://www.example.com/ or sc-domain:example.com)
+        start_date: Start date in YYYY-MM-DD format
+        end_date: End date in YYYY-MM-DD format
+        metric: Metric to sort by (clicks, impressions, ctr, position)
+        limit: Number of results to return
+        dimensions: List of dimensions to rank (query, page, device, country, date; default: page)
+        search_type: Type of search results (web, image, video, news, discover, googleNews)
+        min_impressions: Minimum impressions for a row to be ranked (default: 10 for ctr and position, 0 otherwise)
+        cache: Cache mode: use (default; also answers from data synced with sync_site), refresh (ignore and replace cached responses) or bypass
+        output_format: Output format: table (default), csv, jsonl or columnar-json
+    """
+    try:
+        # Validate metric
+        valid_metrics = ['clicks', 'impressions', 'ctr', 'position']
+        if metric not in valid_metrics:
+            return f"Invalid metric: {metric}. Valid metrics are: {', '.join(valid_metrics)}"
+        
+        # Validate limit
+        if limit < 1:
+            return "limit must be at least 1"
+        
+        # Validate dimensions
+        dimensions = dimensions or ['page']
+        valid_dimensions = ['query', 'page', 'country', 'device', 'date']
+        for dim in dimensions:
+            if dim not in valid_dimensions:
+                return f"Invalid dimension: {dim}. Valid dimensions are: {', '.join(valid_dimensions)}"
+        
+        # Validate search_type
+        valid_search_types = ['web', 'image', 'video', 'news', 'discover', 'googleNews']
+        if search_type not in valid_search_types:
+            return f"Invalid search_type: {search_type}. Valid types are: {', '.join(valid_search_types)}"
+        
+        # Validate cache
+        if cache not in CACHE_MODES:
+            return f"Invalid cache: {cache}. Valid values are: {', '.join(CACHE_MODES)}"
+        
+        # Validate output_format
+        if output_format not in OUTPUT_FORMATS:
+            return f"Invalid output_format: {output_format}. Valid formats are: {', '.join(OUTPUT_FORMATS)}"
+        
+        # CTR and position are only meaningful for rows with enough impressions
+        if min_impressions is None:
+            min_impressions = TOP_CONTENT_MIN_IMPRESSIONS if metric in ['ctr', 'position'] else 0
+        
+        # Build the request body
+        request_body = {
+            'startDate': start_date,
+            'endDate': end_date,
+            'dimensions': dimensions,
+            'searchType': search_type
         }
         
-        # Execute the search analytics query for current period
-        current_response = service.searchanalytics().query(
-            siteUrl=site_url, body=current_request_body).execute()
+        # Stream every page through a bounded heap, so memory stays O(limit)
+        top = _TopK(metric, limit, min_impressions)
+        for page in _iter_query_pages(site_url, request_body, cache=cache):
+            with _span('merge'):
+                top.push_page(page)
+        top_rows = top.rows()
+        
+        # Process and format the results
+        if not top_rows:
+            return "No data found for the specified parameters."
+        
+        def table():
+            # Format the output
+            labels = {'query': 'Queries', 'page': 'Pages', 'country': 'Countries', 'device': 'Devices', 'date': 'Dates'}
+            title = labels[dimensions[0]] if len(dimensions) == 1 else "Rows"
+            result = []
+            result.append(f"Top {limit} {title} by {metric.capitalize()} ({start_date} to {end_date}):")
+            if min_impressions:
+                result.append(f"Only rows with at least {min_impressions} impressions are ranked.")
+            result.append("-" * 80)
+            
+            # Add headers
+            header = ", ".join(dim.capitalize() for dim in dimensions)
+            result.append(f"{header:<50} | {'Clicks':<10} | {'Impressions':<12} | {'CTR':<8} | {'Position':<8}")
+            result.append("-" * 80)
+            
+            # Add data rows
+            rows = []
+            for row in top_rows:
+                key = ", ".join(row.get('keys', ['']))
+                clicks = row.get('clicks', 0)
+                impressions = row.get('impressions', 0)
+                ctr = row.get('ctr', 0) * 100  # Convert to percentage
+                position = row.get('position', 0)
+                
+                rows.append(f"{key[:50]:<50} | {clicks:<10.0f} | {impressions:<12.0f} | {ctr:<8.2f}% | {position:<8.2f}")
+            return result, rows
+        
+        df = _response_to_dataframe({'rows': top_rows}, dimensions)
+        return _render_output(df, output_format, table)
+        
+    except Exception as e:
+        return f"Error: {str(e)}"
+
+@mcp.tool()
+@_async_tool
+def get_search_trends(
+    site_url: str,
+    start_date: str,
+    end_date: str,
+    ctx: Context,
+    interval: str = "week",
+    device: str = None,
+    country: str = None,
+    cache: str = "use",
+    output_format: str = "table"
+) -> str:
+    """
+    Get search trends over time for a site.
+    
+    Daily totals are kept in a local rollup cube, so only days that are
+    missing or not yet final are fetched, and weeks and months are read
+    from pre-aggregated rollups.
+    
+    Args:
+        site_url: Full URL of your website (e.g., https://www.example.com/ or sc-domain:example.com)
+        start_date: Start date in YYYY-MM-DD format
+        end_date: End date in YYYY-MM-DD format
+        interval: Time interval for grouping (day, week, month)
+        device: Only include this device (DESKTOP, MOBILE, TABLET; default: all devices)
+        country: Only include this country, as an ISO 3166-1 alpha-3 code (e.g., usa; default: all countries)
+        cache: Cache mode: use (default; also answers from data synced with sync_site), refresh (ignore and replace cached responses) or bypass
+        output_format: Output format: table (default), csv, jsonl or columnar-json
+    """
+    try:
+        # Validate interval
+        valid_intervals = ['day', 'week', 'month']
+        if interval not in valid_intervals:
+            return f"Invalid interval: {interval}. Valid intervals are: {', '.join(valid_intervals)}"
+        
+        # Validate device
+        valid_devices = ['DESKTOP', 'MOBILE', 'TABLET']
+        device = (device or '').upper()
+        if device and device not in valid_devices:
+            return f"Invalid device: {device}. Valid devices are: {', '.join(valid_devices)}"
+        
+        # Validate country
+        country = (country or '').lower()
+        if country and not re.fullmatch('[a-z]{3}', country):
+            return f"Invalid country: {country}. Use an ISO 3166-1 alpha-3 code such as usa"
+        
+        # Validate cache
+        if cache not in CACHE_MODES:
+            return f"Invalid cache: {cache}. Valid values are: {', '.join(CACHE_MODES)}"
+        
+        # Validate output_format
+        if output_format not in OUTPUT_FORMATS:
+            return f"Invalid output_format: {output_format}. Valid formats are: {', '.join(OUTPUT_FORMATS)}"
+        
+        # Bring the rollup cube up to date; bypass fills a throwaway one instead
+        cube = _rollups if cache != 'bypass' else _RollupCube(None)
+        _fill_rollups(cube, site_url, 'web', device, country, start_date, end_date, cache)
+        
+        # Read the trend and totals; CTR and position come from the summed totals
+        with _span('store'):
+            rows = cube.trend(site_url, 'web', device, country, start_date, end_date, interval)
+            clicks, impressions, weighted_position = cube.totals(
+                site_url, 'web', device, country, start_date, end_date)
+        
+        # Process and format the results
+        if not rows:
+            return "No data found for the specified parameters."
+        
+        with _span('merge'):
+            periods, period_clicks, period_impressions, period_positions = (np.array(column) for column in zip(*rows))
+            grouped_df = pd.DataFrame({
+                'date': periods,
+                'clicks': period_clicks.astype(np.float64),
+                'impressions': period_impressions.astype(np.float64),
+                'ctr': period_clicks / period_impressions,
+                'position': period_positions / period_impressions
+            })
+            totals = {
+                'clicks': int(round(clicks)),
+                'impressions': int(round(impressions)),
+                'ctr': round(clicks / impressions, 4),
+                'position': round(weighted_position / impressions, 2)
+            }
+        
+        def table():
+            # Format the output
+            result = []
+            segment = " ".join(part for part in [device, country] if part)
+            result.append(f"Search Trends by {interval.capitalize()} ({start_date} to {end_date})"
+                          + (f" for {segment}" if segment else "") + ":")
+            result.append(f"Totals: {totals['clicks']} clicks, {totals['impressions']} impressions, "
+                          f"CTR {totals['ctr'] * 100:.2f}%, position {totals['position']:.2f}")
+            result.append("-" * 80)
+            
+            # Add headers
+            result.append(f"{'Date':<12} | {'Clicks':<10} | {'Impressions':<12} | {'CTR':<8} | {'Position':<8}")
+            result.append("-" * 80)
+            
+            # Add data rows, formatting a column at a time
+            return result, _join_columns([
+                [period.ljust(12) for period in grouped_df['date'].tolist()],
+                _format_column(grouped_df['clicks'], '{:<10.0f}'),
+                _format_column(grouped_df['impressions'], '{:<12.0f}'),
+                _format_column(grouped_df['ctr'] * 100, '{:<8.2f}%'),  # Convert to percentage
+                _format_column(grouped_df['position'], '{:<8.2f}')
+            ])
+        
+        return _render_output(grouped_df, output_format, table, totals=totals)
         
-        # Execute the search analytics query for previous period
-        previous_response = service.searchanalytics().query(
-            siteUrl=site_url, body=previous_request_body).execute()
+    except Exception as e:
+        return f"Error: {str(e)}"
+
+@mcp.tool()
+@_async_tool
+def query_multiple_sites(
+    start_date: str,
+    end_date: str,
+    ctx: Context,
+    sites: list = None,
+    site_pattern: str = None,
+    dimensions: list = None,
+    search_type: str = "web",
+    row_limit: int = 1000,
+    cache: str = "use",
+    output_format: str = "table"
+) -> str:
+    """
+    Run the same Search Analytics query across many sites, with a combined rollup.
+    
+    Each site's totals are sent as a log message as soon as it finishes. A site
+    that fails is reported without stopping the others.
+    
+    Args:
+        start_date: Start date in YYYY-MM-DD format
+        end_date: End date in YYYY-MM-DD format
+        sites: List of sites to query (default: all verified sites)
+        site_pattern: Only query sites matching this glob pattern (e.g., *.example.com/ or sc-domain:*)
+        dimensions: List of dimensions (query, page, device, country, date)
+        search_type: Type of search results (web, image, video, news, discover, googleNews)
+        row_limit: Maximum number of rows to return per site (paged past the API's 25000-row limit)
+        cache: Cache mode: use (default; also answers from data synced with sync_site), refresh (ignore and replace cached responses) or bypass
+        output_format: Output format: table (default), csv, jsonl or columnar-json
+    """
+    try:
+        # Validate inputs
+        valid_dimensions = ['query', 'page', 'country', 'device', 'date']
+        if dimensions:
+            for dim in dimensions:
+                if dim not in valid_dimensions:
+                    return f"Invalid dimension: {dim}. Valid dimensions are: {', '.join(valid_dimensions)}"
+        
+        # Validate row_limit
+        if row_limit < 1:
+            return "row_limit must be at least 1"
+            
+        # Validate search_type
+        valid_search_types = ['web', 'image', 'video', 'news', 'discover', 'googleNews']
+        if search_type not in valid_search_types:
+            return f"Invalid search_type: {search_type}. Valid types are: {', '.join(valid_search_types)}"
         
-        # Process and format the results
-        if ('rows' not in current_response or not current_response['rows']) and \
-           ('rows' not in previous_response or not previous_response['rows']):
-            return "No data found for the specified parameters in either period."
+        # Validate cache
+        if cache not in CACHE_MODES:
+            return f"Invalid cache: {cache}. Valid values are: {', '.join(CACHE_MODES)}"
         
-        # Convert responses to DataFrames for easier comparison
-        current_df = _response_to_dataframe(current_response, dimensions)
-        previous_df = _response_to_dataframe(previous_response, dimensions)
+        # Validate output_format
+        if output_format not in OUTPUT_FORMATS:
+            return f"Invalid output_format: {output_format}. Valid formats are: {', '.join(OUTPUT_FORMATS)}"
         
-        # Merge the DataFrames on dimensions
-        if dimensions:
-            merged_df = pd.merge(
-                current_df, previous_df, 
-                on=dimensions, 
-                how='outer', 
-                suffixes=('_current', '_previous')
-            )
-        else:
-            # If no dimensions, create a single row DataFrame with totals
-            merged_df = pd.DataFrame({
-                'clicks_current': [current_df['clicks'].sum() if not current_df.empty else 0],
-                'impressions_current': [current_df['impressions'].sum() if not current_df.empty else 0],
-                'ctr_current': [current_df['ctr'].mean() if not current_df.empty else 0],
-                'position_current': [current_df['position'].mean() if not current_df.empty else 0],
-                'clicks_previous': [previous_df['clicks'].sum() if not previous_df.empty else 0],
-                'impressions_previous': [previous_df['impressions'].sum() if not previous_df.empty else 0],
-                'ctr_previous': [previous_df['ctr'].mean() if not previous_df.empty else 0],
-                'position_previous': [previous_df['position'].mean() if not previous_df.empty else 0]
-            })
+        # Default to every verified site
+        if not sites:
+            sites_list = _execute_api(_client.service().sites().list())
+            sites = [site['siteUrl'] for site in sites_list.get('siteEntry', [])]
+        if site_pattern:
+            sites = [site for site in sites if fnmatch.fnmatchcase(site, site_pattern)]
+        sites = list(dict.fromkeys(sites))
         
-        # Calculate changes
-        merged_df['clicks_change'] = merged_df['clicks_current'].fillna(0) - merged_df['clicks_previous'].fillna(0)
-        merged_df['clicks_change_pct'] = (
-            (merged_df['clicks_current'].fillna(0) - merged_df['clicks_previous'].fillna(0)) / 
-            merged_df['clicks_previous'].fillna(1) * 100
-        )
+        if not sites:
+            return "No sites matched."
         
-        merged_df['impressions_change'] = merged_df['impressions_current'].fillna(0) - merged_df['impressions_previous'].fillna(0)
-        merged_df['impressions_change_pct'] = (
-            (merged_df['impressions_current'].fillna(0) - merged_df['impressions_previous'].fillna(0)) / 
-            merged_df['impressions_previous'].fillna(1) * 100
-        )
+        # Build the request body
+        request_body = {
+            'startDate': start_date,
+            'endDate': end_date,
+            'dimensions': dimensions or [],
+            'searchType': search_type
+        }
         
-        merged_df['ctr_change'] = merged_df['ctr_current'].fillna(0) - merged_df['ctr_previous'].fillna(0)
-        merged_df['ctr_change_pct'] = (
-            (merged_df['ctr_current'].fillna(0) - merged_df['ctr_previous'].fillna(0)) / 
-            merged_df['ctr_previous'].fillna(0.01) * 100
-        )
+        # Query every site on the fan-out pool; they share the client, cache and rate limiter
+        _plan_queries(len(sites))
+        futures = {
+            _submit(_site_executor, _fetch_dataframe, site, request_body, dimensions, row_limit, cache): site
+            for site in sites
+        }
         
-        merged_df['position_change'] = merged_df['position_previous'].fillna(0) - merged_df['position_current'].fillna(0)
+        # Report each site as it finishes
+        site_dfs = {}
+        errors = {}
+        for done, future in enumerate(as_completed(futures), start=1):
+            site = futures[future]
+            try:
+                site_dfs[site] = future.result()
+            except Exception as e:
+                # Every remaining site fails the same way once the call is cancelled
+                _check_cancelled()
+                errors[site] = str(e)
+                _notify(ctx, f"[{done}/{len(sites)}] {site}: Error: {str(e)}")
+                continue
+            
+            totals = _result_totals(site_dfs[site])
+            _notify(ctx, f"[{done}/{len(sites)}] {site}: {len(site_dfs[site])} rows, "
+                         f"{totals['clicks']} clicks, {totals['impressions']} impressions")
         
-        # Format the output
-        result = []
+        if all(df.empty for df in site_dfs.values()) and not errors:
+            return "No data found for the specified parameters in any site."
         
-        # Add period information
-        result.append(f"Comparison between:")
-        result.append(f"Current period: {current_start_date} to {current_end_date}")
-        result.append(f"Previous period: {previous_start_date} to {previous_end_date}")
-        result.append("")
+        with _span('merge'):
+            df, totals = _rollup_sites(site_dfs, errors, dimensions, row_limit)
         
-        # Format the DataFrame as a string table
-        if dimensions:
-            # Select columns for display
-            display_cols = dimensions + [
-                'clicks_current', 'clicks_previous', 'clicks_change', 'clicks_change_pct',
-                'impressions_current', 'impressions_previous', 'impressions_change', 'impressions_change_pct',
-                'ctr_current', 'ctr_previous', 'ctr_change', 'ctr_change_pct',
-                'position_current', 'position_previous', 'position_change'
-            ]
-            display_df = merged_df[display_cols].fillna(0)
-            
-            # Sort by current clicks (descending)
-            display_df = display_df.sort_values('clicks_current', ascending=False)
+        def table():
+            headers = ['site_url'] + (dimensions or []) + ['clicks', 'impressions', 'ctr', 'position']
             
-            # Format the DataFrame as a string
-            output = StringIO()
+            result = []
+            result.append(f"Results for {len(sites)} sites, {len(errors)} failed ({start_date} to {end_date}):")
+            if (df['site_url'] == ALL_SITES).any():
+                result.append(f"Rows for {ALL_SITES} combine every site, with CTR and position recomputed from the sums.")
+            result.append("")
+            result.append(" | ".join(headers))
+            result.append("-" * (sum(len(h) for h in headers) + 3 * len(headers)))
             
-            # Format float columns
-            for col in display_df.columns:
-                if 'ctr' in col:
-                    display_df[col] = display_df[col].apply(lambda x: f"{x*100:.2f}%" if 'change_pct' not in col else f"{x:.2f}%")
-                elif 'position' in col:
-                    display_df[col] = display_df[col].apply(lambda x: f"{x:.2f}")
-                elif 'change_pct' in col:
-                    display_df[col] = display_df[col].apply(lambda x: f"{x:.2f}%")
+            # Format a column at a time
+            columns = [_format_text(df[column]) for column in ['site_url'] + (dimensions or [])]
+            columns.append(_format_column(df['clicks'], '{:.0f}'))
+            columns.append(_format_column(df['impressions'], '{:.0f}'))
+            columns.append(_format_column(df['ctr'] * 100, '{:.2f}%'))
+            columns.append(_format_column(df['position'], '{:.2f}'))
+            rows = _join_columns(columns)
             
-            # Convert to string table
-            table_str = display_df.to_string(index=False)
-            result.append(table_str)
-        else:
-            # For no dimensions, just show the totals
-            row = merged_df.iloc[0]
-            result.append("Overall Metrics:")
-            result.append(f"Clicks: {row['clicks_current']:.0f} vs {row['clicks_previous']:.0f} ({row['clicks_change']:.0f}, {row['clicks_change_pct']:.2f}%)")
-            result.append(f"Impressions: {row['impressions_current']:.0f} vs {row['impressions_previous']:.0f} ({row['impressions_change']:.0f}, {row['impressions_change_pct']:.2f}%)")
-            result.append(f"CTR: {row['ctr_current']*100:.2f}% vs {row['ctr_previous']*100:.2f}% ({row['ctr_change']*100:.2f}%, {row['ctr_change_pct']:.2f}%)")
-            result.append(f"Position: {row['position_current']:.2f} vs {row['position_previous']:.2f} ({row['position_change']:.2f})")
+            # Failed sites have an error instead of metrics
+            if 'error' in df:
+                for i, (site, error) in enumerate(zip(df['site_url'], df['error'])):
+                    if isinstance(error, str):
+                        rows[i] = f"{site} | Error: {error}"
+            return result, rows
         
-        return "\n".join(result)
+        return _render_output(df, output_format, table, totals=totals)
         
     except Exception as e:
         return f"Error: {str(e)}"
 
 @mcp.tool()
-def get_top_performing_content(
+@_async_tool
+def export_search_analytics(
     site_url: str,
     start_date: str,
     end_date: str,
+    output_path: str,
     ctx: Context,
-    metric: str = "clicks",
-    limit: int = 10
+    dimensions: list = None,
+    search_type: str = "web",
+    filters: list = None,
+    file_format: str = None,
+    overwrite: bool = False
 ) -> str:
     """
-    Get the top performing content based on a specific metric.
+    Export every row of a Search Analytics query to a local CSV or Parquet file.
+    
+    Rows are streamed to the file a page (up to 25000 rows) at a time, so memory
+    stays bounded however large the export is. Returns the file's path, row count,
+    size and totals. An interrupted export resumes from its last completed page
+    when it is run again with the same arguments.
     
     Args:
         site_url: Full URL of your website (e.g., https://www.example.com/ or sc-domain:example.com)
         start_date: Start date in YYYY-MM-DD format
         end_date: End date in YYYY-MM-DD format
-        metric: Metric to sort by (clicks, impressions, ctr, position)
-        limit: Number of results to return
+        output_path: File to write, relative to GSC_EXPORT_DIR; it must stay inside that directory
+        dimensions: List of dimensions (query, page, device, country, date)
+        search_type: Type of search results (web, image, video, news, discover, googleNews)
+        filters: Dimension filters applied by the API; rows must match all of them (see query_search_analytics)
+        file_format: csv or parquet (requires pyarrow); defaults to output_path's extension, or csv
+        overwrite: Replace output_path if it exists and isn't an interrupted export of this query
     """
     try:
-        # Get credentials file path from environment variable
-        credentials_file = os.environ.get('GOOGLE_APPLICATION_CREDENTIALS')
-        
-        if not credentials_file:
-            return "Error: GOOGLE_APPLICATION_CREDENTIALS environment variable not set"
-            
-        if not os.path.exists(credentials_file):
-            return f"Error: Credentials file not found at {credentials_file}"
+        # Validate inputs
+        valid_dimensions = ['query', 'page', 'country', 'device', 'date']
+        if dimensions:
+            for dim in dimensions:
+                if dim not in valid_dimensions:
+                    return f"Invalid dimension: {dim}. Valid dimensions are: {', '.join(valid_dimensions)}"
         
-        # Authenticate using service account credentials
-        credentials = service_account.Credentials.from_service_account_file(
-            credentials_file, scopes=SCOPES)
-            
-        # Set up the Search Console API service
-        service = build('webmasters', 'v3', credentials=credentials)
+        # Validate search_type
+        valid_search_types = ['web', 'image', 'video', 'news', 'discover', 'googleNews']
+        if search_type not in valid_search_types:
+            return f"Invalid search_type: {search_type}. Valid types are: {', '.join(valid_search_types)}"
         
-        # Validate metric
-        valid_metrics = ['clicks', 'impressions', 'ctr', 'position']
-        if metric not in valid_metrics:
-            return f"Invalid metric: {metric}. Valid metrics are: {', '.join(valid_metrics)}"
+        # Validate filters
+        filter_error = _validate_filters(filters)
+        if filter_error:
+            return filter_error
+        
+        # Validate output_path: clients choose it, so absolute paths, .. and symlinks
+        # must not reach files outside the export directory
+        export_dir = os.path.realpath(EXPORT_DIR)
+        path = os.path.realpath(os.path.join(export_dir, output_path))
+        if os.path.commonpath([export_dir, path]) != export_dir or path == export_dir:
+            return f"Invalid output_path: {output_path}. It must be a file inside {export_dir}"
+        
+        # Validate file_format, defaulting to the file's extension
+        if file_format is None:
+            extension = os.path.splitext(path)[1].lstrip('.').lower()
+            file_format = extension if extension in EXPORT_FORMATS else 'csv'
+        if file_format not in EXPORT_FORMATS:
+            return f"Invalid file_format: {file_format}. Valid formats are: {', '.join(EXPORT_FORMATS)}"
+        if file_format == 'parquet':
+            try:
+                importlib.import_module('pyarrow.parquet')
+            except ImportError:
+                return "Parquet export requires pyarrow. Install it with: pip install pyarrow"
         
         # Build the request body
         request_body = {
             'startDate': start_date,
             'endDate': end_date,
-            'dimensions': ['page'],
-            'searchType': 'web',
-            'rowLimit': 1000  # Get a large number to ensure we have enough data
+            'dimensions': dimensions or [],
+            'searchType': search_type
         }
-        
-        # Execute the search analytics query
-        response = service.searchanalytics().query(siteUrl=site_url, body=request_body).execute()
-        
-        # Process and format the results
-        if 'rows' not in response or not response['rows']:
-            return "No data found for the specified parameters."
-        
-        rows = response['rows']
-        
-        # Sort by the specified metric
-        if metric == 'position':
-            # For position, lower is better
-            sorted_rows = sorted(rows, key=lambda x: x.get(metric, 0))
-        else:
-            # For other metrics, higher is better
-            sorted_rows = sorted(rows, key=lambda x: x.get(metric, 0), reverse=True)
-        
-        # Take the top N results
-        top_rows = sorted_rows[:limit]
-        
-        # Format the output
+        if filters:
+            request_body['dimensionFilterGroups'] = _filter_groups(filters)
+        
+        export = _Export(path, file_format, request_body)
+        resumed_rows = export.progress['rows'] if export.resume() else None
+        if resumed_rows is None and os.path.exists(path) and not overwrite:
+            return f"{path} already exists. Set overwrite to true to replace it."
+        
+        # Pages bypass the response cache, which they would flush, and run at
+        # background priority so interactive tool calls go first
+        export.start()
+        try:
+            for rows in _iter_pages(site_url, request_body, cache='bypass', priority=PRIORITY_BACKGROUND,
+                                    start_row=export.progress['rows']):
+                export.write_page(_response_to_dataframe({'rows': rows}, dimensions))
+            export.finish()
+        except Exception as e:
+            export.close()
+            return (f"Error: {str(e)}. {export.progress['rows']} rows were exported to {path} before the error; "
+                    f"run the same export again to resume.")
+        
+        # Format the result
+        progress = export.progress
         result = []
-        result.append(f"Top {limit} Pages by {metric.capitalize()} ({start_date} to {end_date}):")
-        result.append("-" * 80)
-        
-        # Add headers
-        result.append(f"{'Page':<50} | {'Clicks':<10} | {'Impressions':<12} | {'CTR':<8} | {'Position':<8}")
-        result.append("-" * 80)
-        
-        # Add data rows
-        for row in top_rows:
-            page = row.get('keys', [''])[0]
-            clicks = row.get('clicks', 0)
-            impressions = row.get('impressions', 0)
-            ctr = row.get('ctr', 0) * 100  # Convert to percentage
-            position = row.get('position', 0)
-            
-            result.append(f"{page[:50]:<50} | {clicks:<10.0f} | {impressions:<12.0f} | {ctr:<8.2f}% | {position:<8.2f}")
-        
+        if resumed_rows:
+            result.append(f"Resumed an interrupted export after {resumed_rows} rows.")
+        result.append(f"Exported {progress['rows']} rows to {path} ({os.path.getsize(path)} bytes, {file_format}).")
+        if progress['impressions']:
+            result.append(
+                f"Totals: clicks {progress['clicks']}, impressions {progress['impressions']}, "
+                f"CTR {progress['clicks'] / progress['impressions'] * 100:.2f}%, "
+                f"position {progress['weighted_position'] / progress['impressions']:.2f}")
         return "\n".join(result)
         
     except Exception as e:
         return f"Error: {str(e)}"
 
 @mcp.tool()
-def get_search_trends(
+@_async_tool
+def sync_site(
     site_url: str,
     start_date: str,
     end_date: str,
     ctx: Context,
-    interval: str = "week"
+    dimensions: list = None,
+    search_type: str = "web"
 ) -> str:
     """
-    Get search trends over time for a site.
+    Sync daily Search Console data for a site into the local store.
+    
+    Only days that are missing or not yet final are fetched. Once a date range is
+    synced, the analytics tools answer requests for the same dimensions and
+    search type from the local store instead of the API.
     
     Args:
         site_url: Full URL of your website (e.g., https://www.example.com/ or sc-domain:example.com)
         start_date: Start date in YYYY-MM-DD format
         end_date: End date in YYYY-MM-DD format
-        interval: Time interval for grouping (day, week, month)
+        dimensions: List of dimensions to store per day (query, page, device, country)
+        search_type: Type of search results (web, image, video, news, discover, googleNews)
     """
     try:
-        # Get credentials file path from environment variable
-        credentials_file = os.environ.get('GOOGLE_APPLICATION_CREDENTIALS')
-        
-        if not credentials_file:
-            return "Error: GOOGLE_APPLICATION_CREDENTIALS environment variable not set"
-            
-        if not os.path.exists(credentials_file):
-            return f"Error: Credentials file not found at {credentials_file}"
-        
-        # Authenticate using service account credentials
-        credentials = service_account.Credentials.from_service_account_file(
-            credentials_file, scopes=SCOPES)
-            
-        # Set up the Search Console API service
-        service = build('webmasters', 'v3', credentials=credentials)
-        
-        # Validate interval
-        valid_intervals = ['day', 'week', 'month']
-        if interval not in valid_intervals:
-            return f"Invalid interval: {interval}. Valid intervals are: {', '.join(valid_intervals)}"
-        
-        # Build the request body
-        request_body = {
-            'startDate': start_date,
-            'endDate': end_date,
-            'dimensions': ['date'],
-            'searchType': 'web',
-            'rowLimit': 1000
-        }
+        # Validate inputs
+        valid_dimensions = ['query', 'page', 'country', 'device', 'date']
+        if dimensions:
+            for dim in dimensions:
+                if dim not in valid_dimensions:
+                    return f"Invalid dimension: {dim}. Valid dimensions are: {', '.join(valid_dimensions)}"
         
-        # Execute the search analytics query
-        response = service.searchanalytics().query(siteUrl=site_url, body=request_body).execute()
+        # Validate search_type
+        valid_search_types = ['web', 'image', 'video', 'news', 'discover', 'googleNews']
+        if search_type not in valid_search_types:
+            return f"Invalid search_type: {search_type}. Valid types are: {', '.join(valid_search_types)}"
         
-        # Process and format the results
-        if 'rows' not in response or not response['rows']:
-            return "No data found for the specified parameters."
+        synced_days, rows, current_days = _warehouse.sync(
+            site_url, start_date, end_date, dimensions, search_type)
         
-        rows = response['rows']
+        return (f"Synced {synced_days} days ({rows} rows) for {site_url}; "
+                f"{current_days} days were already up to date.")
         
-        # Convert to DataFrame for easier manipulation
-        df = pd.DataFrame([
-            {
-                'date': row['keys'][0],
-                'clicks': row.get('clicks', 0),
-                'impressions': row.get('impressions', 0),
-                'ctr': row.get('ctr', 0),
-                'position': row.get('position', 0)
-            }
-            for row in rows
-        ])
-        
-        # Convert date string to datetime
-        df['date'] = pd.to_datetime(df['date'])
-        
-        # Group by the specified interval
-        if interval == 'day':
-            # Already grouped by day
-            grouped_df = df
-        elif interval == 'week':
-            # Group by week
-            df['week'] = df['date'].dt.to_period('W').apply(lambda r: r.start_time)
-            grouped_df = df.groupby('week').agg({
-                'clicks': 'sum',
-                'impressions': 'sum',
-                'ctr': 'mean',
-                'position': 'mean'
-            }).reset_index()
-            grouped_df.rename(columns={'week': 'date'}, inplace=True)
-        elif interval == 'month':
-            # Group by month
-            df['month'] = df['date'].dt.to_period('M').apply(lambda r: r.start_time)
-            grouped_df = df.groupby('month').agg({
-                'clicks': 'sum',
-                'impressions': 'sum',
-                'ctr': 'mean',
-                'position': 'mean'
-            }).reset_index()
-            grouped_df.rename(columns={'month': 'date'}, inplace=True)
-        
-        # Sort by date
-        grouped_df = grouped_df.sort_values('date')
+    except Exception as e:
+        return f"Error: {str(e)}"
+
+@mcp.tool()
+@_async_tool
+def get_api_status(ctx: Context) -> str:
+    """Show the API request scheduler's queue depth, wait times and retries."""
+    try:
+        stats = _scheduler.stats()
         
-        # Format the output
         result = []
-        result.append(f"Search Trends by {interval.capitalize()} ({start_date} to {end_date}):")
-        result.append("-" * 80)
-        
-        # Add headers
-        result.append(f"{'Date':<12} | {'Clicks':<10} | {'Impressions':<12} | {'CTR':<8} | {'Position':<8}")
-        result.append("-" * 80)
-        
-        # Add data rows
-        for _, row in grouped_df.iterrows():
-            date_str = row['date'].strftime('%Y-%m-%d')
-            clicks = row['clicks']
-            impressions = row['impressions']
-            ctr = row['ctr'] * 100  # Convert to percentage
-            position = row['position']
-            
-            result.append(f"{date_str:<12} | {clicks:<10.0f} | {impressions:<12.0f} | {ctr:<8.2f}% | {position:<8.2f}")
+        result.append(f"Queued requests: {stats['interactive_queued']} interactive, {stats['background_queued']} background")
+        result.append(f"Requests sent: {stats['requests']}")
+        result.append(f"Average wait: {stats['average_wait'] * 1000:.1f} ms (max {stats['max_wait'] * 1000:.1f} ms)")
+        result.append(f"Retries: {stats['retries']}")
+        result.append(f"Rate limits: {_scheduler.site_qps:g} requests/s per site, {_scheduler.project_qps:g} requests/s per project")
         
         return "\n".join(result)
         
     except Exception as e:
         return f"Error: {str(e)}"
 
-def _response_to_dataframe(response, dimensions):
-    """Helper function to convert API response to pandas DataFrame"""
-    if 'rows' not in response or not response['rows']:
-        return pd.DataFrame()
+@mcp.tool()
+@_async_tool
+def clear_cache(ctx: Context, site_url: str = None) -> str:
+    """
+    Remove cached Search Console responses.
+    
+    Args:
+        site_url: Only remove responses for this site (default: all sites)
+    """
+    try:
+        removed = _cache.invalidate(site_url)
+        return f"Removed {removed} cached responses."
+        
+    except Exception as e:
+        return f"Error: {str(e)}"
+
+@mcp.resource("gsc://metrics", mime_type="application/json")
+def metrics() -> str:
+    """Counters and per-phase timings of tool calls and API requests since the server started."""
+    snapshot = _metrics.snapshot()
+    snapshot['scheduler'] = _scheduler.stats()
+    return json.dumps(snapshot, indent=2)
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the metrics in the Prometheus text format at /metrics"""
+    
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = _metrics.prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+def _serve_metrics(port):
+    """Serve the Prometheus endpoint on a background thread"""
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='gsc-metrics', daemon=True).start()
+    return server
+
+def _add_period_changes(merged_df, label, suffix):
+    """Add columns with the change between the current period and the labelled one"""
+    current = {m: merged_df[f'{m}_current'].fillna(0) for m in ['clicks', 'impressions', 'ctr', 'position']}
+    other = {m: merged_df[f'{m}_{label}'] for m in ['clicks', 'impressions', 'ctr', 'position']}
+    
+    merged_df['clicks_change' + suffix] = current['clicks'] - other['clicks'].fillna(0)
+    merged_df['clicks_change_pct' + suffix] = (
+        (current['clicks'] - other['clicks'].fillna(0)) / other['clicks'].fillna(1) * 100
+    )
+    
+    merged_df['impressions_change' + suffix] = current['impressions'] - other['impressions'].fillna(0)
+    merged_df['impressions_change_pct' + suffix] = (
+        (current['impressions'] - other['impressions'].fillna(0)) / other['impressions'].fillna(1) * 100
+    )
+    
+    merged_df['ctr_change' + suffix] = current['ctr'] - other['ctr'].fillna(0)
+    merged_df['ctr_change_pct' + suffix] = (
+        (current['ctr'] - other['ctr'].fillna(0)) / other['ctr'].fillna(0.01) * 100
+    )
+    
+    merged_df['position_change' + suffix] = other['position'].fillna(0) - current['position']
+
+class _Export:
+    """
+    A resumable export of one query's rows to a CSV or Parquet file.
+    
+    Progress is saved next to the output after every page, so running the same
+    export again skips the pages already written. CSV pages are appended to the
+    output; a resumed export first cuts off anything written after the last
+    completed page. Parquet files can't be appended to, so pages are written as
+    part files and combined into the output, a row group per page, at the end.
+    """
+    
+    def __init__(self, path, file_format, request_body):
+        self.path = path
+        self.file_format = file_format
+        self.request_body = request_body
+        self.dimensions = request_body['dimensions']
+        self.progress_path = path + '.progress.json'
+        self.parts_dir = path + '.parts'
+        self.progress = {
+            'request': request_body, 'format': file_format, 'rows': 0, 'pages': 0, 'size': 0,
+            'clicks': 0, 'impressions': 0, 'weighted_position': 0.0
+        }
+        self._file = None
+    
+    def resume(self):
+        """Load the progress of an interrupted export of the same query; returns whether there was one"""
+        try:
+            with open(self.progress_path) as f:
+                progress = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return False
+        if progress.get('request') != self.request_body or progress.get('format') != self.file_format:
+            return False
+        self.progress = progress
+        return True
+    
+    def start(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if self.file_format == 'csv':
+            if self.progress['pages']:
+                self._file = open(self.path, 'r+b')
+                self._file.truncate(self.progress['size'])
+                self._file.seek(self.progress['size'])
+            else:
+                self._file = open(self.path, 'wb')
+                self._file.write(
+                    (",".join(self.dimensions + ['clicks', 'impressions', 'ctr', 'position']) + "\n").encode('utf-8'))
+        else:
+            os.makedirs(self.parts_dir, exist_ok=True)
+        self._save_progress()
+    
+    def write_page(self, df):
+        """Write one page of rows, then record it as completed"""
+        df['clicks'] = df['clicks'].astype('int64')
+        df['impressions'] = df['impressions'].astype('int64')
+        
+        if self.file_format == 'csv':
+            self._file.write(df.to_csv(index=False, header=False, lineterminator="\n").encode('utf-8'))
+            self._file.flush()
+            self.progress['size'] = self._file.tell()
+        else:
+            # Write the part under a temporary name, so a part file is always complete
+            part = self._part_path(self.progress['pages'])
+            pq.write_table(self._arrow_table(df), part + '.tmp')
+            os.replace(part + '.tmp', part)
+        
+        self.progress['rows'] += len(df)
+        self.progress['pages'] += 1
+        self.progress['clicks'] += int(df['clicks'].sum())
+        self.progress['impressions'] += int(df['impressions'].sum())
+        self.progress['weighted_position'] += float((df['position'] * df['impressions']).sum())
+        self._save_progress()
+    
+    def finish(self):
+        """Complete the output file and remove the progress"""
+        self.close()
+        if self.file_format == 'parquet':
+            with pq.ParquetWriter(self.path + '.tmp', self._arrow_schema()) as writer:
+                for page in range(self.progress['pages']):
+                    writer.write_table(pq.read_table(self._part_path(page)))
+            os.replace(self.path + '.tmp', self.path)
+            for page in range(self.progress['pages']):
+                os.remove(self._part_path(page))
+            os.rmdir(self.parts_dir)
+        os.remove(self.progress_path)
+    
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+    
+    def _part_path(self, page):
+        return os.path.join(self.parts_dir, f'part-{page:06d}.parquet')
+    
+    def _arrow_schema(self):
+        # Fixed types, so every part has the same schema whatever its values
+        return pa.schema(
+            [(dim, pa.string()) for dim in self.dimensions] +
+            [('clicks', pa.int64()), ('impressions', pa.int64()), ('ctr', pa.float64()), ('position', pa.float64())])
+    
+    def _arrow_table(self, df):
+        schema = self._arrow_schema()
+        columns = [pa.array(df[dim].astype(object), type=pa.string(), from_pandas=True) for dim in self.dimensions]
+        columns += [pa.array(df[metric].to_numpy()) for metric in ['clicks', 'impressions', 'ctr', 'position']]
+        return pa.Table.from_arrays(columns, schema=schema)
+    
+    def _save_progress(self):
+        # Replace the file in one step, so an interruption never leaves it half written
+        with open(self.progress_path + '.tmp', 'w') as f:
+            json.dump(self.progress, f)
+        os.replace(self.progress_path + '.tmp', self.progress_path)
+
+class _TopK:
+    """Bounded min-heap of the best rows by one metric, fed a page at a time"""
+    
+    def __init__(self, metric, limit, min_impressions=0):
+        self.metric = metric
+        self.limit = limit
+        self.min_impressions = min_impressions
+        
+        # Lower positions are better, so positions are ranked by their negative
+        self._sign = -1.0 if metric == 'position' else 1.0
+        
+        # Entries are (score, -row number, row); on equal scores the earlier row ranks higher
+        self._heap = []
+        self._seen = 0
+    
+    def push_page(self, rows):
+        """Offer a page of API rows, keeping those that make it into the top"""
+        count = len(rows)
+        scores = self._sign * np.fromiter((row.get(self.metric, 0) for row in rows), dtype=np.float64, count=count)
+        impressions = np.fromiter((row.get('impressions', 0) for row in rows), dtype=np.float64, count=count)
+        
+        # Drop rows below the impressions threshold or no better than the current worst entry
+        eligible = impressions >= self.min_impressions
+        if len(self._heap) == self.limit:
+            eligible &= scores > self._heap[0][0]
+        candidates = np.flatnonzero(eligible)
+        
+        # At most `limit` rows of a page can make it in; a stable sort keeps the earlier of equal rows
+        if len(candidates) > self.limit:
+            candidates = candidates[np.argsort(-scores[candidates], kind='stable')[:self.limit]]
+        
+        for i in candidates.tolist():
+            entry = (float(scores[i]), -(self._seen + i), rows[i])
+            if len(self._heap) < self.limit:
+                heapq.heappush(self._heap, entry)
+            elif entry[:2] > self._heap[0][:2]:
+                heapq.heapreplace(self._heap, entry)
+        self._seen += count
+    
+    def rows(self):
+        """Return the kept rows, best first"""
+        return [entry[2] for entry in sorted(self._heap, key=lambda entry: entry[:2], reverse=True)]
+
+def _rollup_sites(site_dfs, errors, dimensions, row_limit):
+    """
+    Stack per-site results under a site_url column, led by their cross-site rollup.
+    
+    Rollup rows have site_url ALL_SITES, with clicks and impressions summed over
+    sites, CTR recomputed and impression-weighted position. Sites follow in order
+    of their total clicks, then one row per failed site. Returns the frame and
+    the totals over every site.
+    """
+    metrics = ['clicks', 'impressions', 'ctr', 'position']
+    keys = list(dimensions or [])
+    error_rows = pd.DataFrame({'site_url': list(errors), 'error': list(errors.values())})
+    frames = [df.assign(site_url=site) for site, df in site_dfs.items() if not df.empty]
+    if not frames:
+        # Without any rows a rollup of zeros would look like real data; only the failures are returned
+        return error_rows.reindex(columns=['site_url'] + keys + metrics + ['error']), {}
+    combined = pd.concat(frames, ignore_index=True)
+    totals = _result_totals(combined)
+    
+    # Combine all sites, keeping the top rows by clicks
+    combined['weighted_position'] = combined['position'] * combined['impressions']
+    sums = ['clicks', 'impressions', 'weighted_position']
+    if keys:
+        rollup = combined.groupby(keys, observed=True, sort=False)[sums].sum().reset_index()
+    else:
+        rollup = combined[sums].sum().to_frame().T
+    impressions = rollup['impressions'].where(rollup['impressions'] > 0)
+    rollup['ctr'] = (rollup['clicks'] / impressions).fillna(0)
+    rollup['position'] = (rollup['weighted_position'] / impressions).fillna(0)
+    rollup = rollup.sort_values('clicks', ascending=False, kind='stable').head(row_limit)
+    rollup['site_url'] = ALL_SITES
+    
+    # Each site keeps the API's order of its rows
+    site_clicks = combined.groupby('site_url', sort=False)['clicks'].sum().sort_values(ascending=False, kind='stable')
+    order = {site: i for i, site in enumerate(site_clicks.index)}
+    per_site = combined.iloc[np.argsort(combined['site_url'].map(order).to_numpy(), kind='stable')]
+    
+    parts = [rollup[['site_url'] + keys + metrics], per_site[['site_url'] + keys + metrics]]
+    if errors:
+        parts.append(error_rows)
+    return pd.concat(parts, ignore_index=True), totals
+
+def _validate_filters(filters):
+    """Return an error message for invalid tool filters, or None"""
+    for f in filters or []:
+        if not isinstance(f, dict) or 'dimension' not in f or 'expression' not in f:
+            return "Each filter must be an object with dimension, operator and expression"
+        if f['dimension'] not in FILTER_DIMENSIONS:
+            return f"Invalid filter dimension: {f['dimension']}. Valid dimensions are: {', '.join(FILTER_DIMENSIONS)}"
+        if f.get('operator', 'equals') not in FILTER_OPERATORS:
+            return f"Invalid filter operator: {f['operator']}. Valid operators are: {', '.join(FILTER_OPERATORS)}"
+    return None
+
+def _filter_groups(filters):
+    """Build the API's dimensionFilterGroups from tool filters"""
+    return [{
+        'groupType': 'and',
+        'filters': [
+            {'dimension': f['dimension'], 'operator': f.get('operator', 'equals'), 'expression': str(f['expression'])}
+            for f in filters
+        ]
+    }]
+
+def _request_filters(request_body):
+    """Return the filters of a request body; the tools only send one group, so all must match"""
+    return [f for group in request_body.get('dimensionFilterGroups') or [] for f in group.get('filters', [])]
+
+def _filter_records(records, dimensions, filters):
+    """Keep the records (dimension values first, in dimensions order) matching every filter"""
+    keep = np.ones(len(records), dtype=bool)
+    for f in filters:
+        i = dimensions.index(f['dimension'])
+        values = np.array([record[i] for record in records], dtype=object)
+        keep &= _filter_mask(values, f.get('operator', 'equals'), f['expression'])
+    return list(itertools.compress(records, keep))
+
+def _filter_mask(values, operator, expression):
+    """
+    Evaluate a dimension filter over an array of values, as the API does.
+    
+    Each distinct value is matched once. contains and notContains ignore case,
+    and regular expressions match anywhere in the value (Python's re stands in
+    for the API's RE2, which it mostly agrees with).
+    """
+    codes, uniques = pd.factorize(values, use_na_sentinel=False)
+    uniques = pd.Series(uniques, dtype=object)
+    if operator in ('equals', 'notEquals'):
+        matches = (uniques == expression).to_numpy(dtype=bool)
+    elif operator in ('contains', 'notContains'):
+        matches = uniques.str.lower().str.contains(expression.lower(), regex=False, na=False).to_numpy(dtype=bool)
+    else:
+        matches = uniques.str.contains(expression, regex=True, na=False).to_numpy(dtype=bool)
+    if operator in ('notEquals', 'notContains', 'excludingRegex'):
+        matches = ~matches
+    return matches[codes]
+
+def _rollup_slice(filters):
+    """Return the (device, country) slice of the rollup cube that filters select, or None if it has none"""
+    slice_key = {'device': '', 'country': ''}
+    for f in filters or []:
+        dimension = f['dimension']
+        if dimension not in slice_key or f.get('operator', 'equals') != 'equals' or slice_key[dimension]:
+            return None
+        # The API reports devices in upper case and countries as lower-case ISO 3166-1 alpha-3 codes
+        slice_key[dimension] = f['expression'].upper() if dimension == 'device' else f['expression'].lower()
+    return slice_key['device'], slice_key['country']
+
+def _fill_rollups(cube, site_url, search_type, device, country, start_date, end_date, cache='use',
+                  priority=PRIORITY_INTERACTIVE):
+    """
+    Fetch the daily totals a rollup cube is missing for a slice and range.
+    
+    With cache 'use' only days that are missing or not current are fetched,
+    one query per run of consecutive days; otherwise the whole range is.
+    """
+    current = set()
+    if cache == 'use':
+        with _span('store'):
+            current = cube.current_days(site_url, search_type, device, country, start_date, end_date)
+    runs = _Warehouse.day_runs(
+        [day for day in _Warehouse._days(start_date, end_date) if day not in current])
+    
+    filters = [{'dimension': dimension, 'expression': expression}
+               for dimension, expression in [('device', device), ('country', country)] if expression]
+    
+    def fetch_run(run_start, run_end):
+        request_body = {
+            'startDate': run_start,
+            'endDate': run_end,
+            'dimensions': ['date'],
+            'searchType': search_type
+        }
+        if filters:
+            request_body['dimensionFilterGroups'] = _filter_groups(filters)
+        df = _fetch_dataframe(site_url, request_body, ['date'], cache=cache, priority=priority)
+        with _span('store'):
+            cube.store_slice(site_url, search_type, device, country, run_start, run_end, zip(
+                df['date'].astype(str).tolist(), df['clicks'].tolist(), df['impressions'].tolist(),
+                (df['position'] * df['impressions']).tolist()))
+    
+    _plan_queries(len(runs))
+    futures = [_submit(_query_executor, fetch_run, run[0], run[-1]) for run in runs]
+    for future in futures:
+        future.result()
+
+def _fetch_dataframe(site_url, request_body, dimensions, max_rows=None, cache='use', priority=PRIORITY_INTERACTIVE):
+    """Fetch every page of a query into a single DataFrame"""
+    frames = [
+        _response_to_dataframe({'rows': rows}, dimensions)
+        for rows in _iter_query_pages(site_url, request_body, max_rows, cache, priority)
+    ]
+    if not frames:
+        return _response_to_dataframe({}, dimensions)
+    if len(frames) == 1:
+        return frames[0]
+    
+    # Concatenate column by column so dimensions stay categorical across pages
+    with _span('merge'):
+        columns = {dim: pd.api.types.union_categoricals([df[dim] for df in frames]) for dim in dimensions or []}
+        for metric in ['clicks', 'impressions', 'ctr', 'position']:
+            columns[metric] = np.concatenate([df[metric].to_numpy() for df in frames])
+        return pd.DataFrame(columns)
+
+def _fetch_chunked_dataframe(site_url, request_body, dimensions, chunk_by, max_rows=None, cache='use'):
+    """
+    Fetch a query as one sub-query per day or week of its date range.
+    
+    The API drops more rows of high-cardinality dimensions (query, page) the
+    longer the range, so summing short ranges returns many more distinct rows.
+    Sub-queries run in parallel under the rate limiter, each fetching up to
+    max_rows rows, and are merged with _merge_chunks.
+    """
+    days = CHUNK_DAYS[chunk_by]
+    chunks = _date_chunks(request_body['startDate'], request_body['endDate'], days) if days else []
+    if len(chunks) <= 1:
+        return _fetch_dataframe(site_url, request_body, dimensions, max_rows, cache)
+    
+    # The first chunk takes the place of the unchunked query in the progress estimate
+    _plan_queries(len(chunks) - 1)
+    futures = [
+        _submit(_chunk_executor, _fetch_dataframe, site_url,
+                dict(request_body, startDate=start_date, endDate=end_date), dimensions, max_rows, cache)
+        for start_date, end_date in chunks
+    ]
+    try:
+        frames = [future.result() for future in futures]
+    except Exception:
+        # Don't spend quota on the rest of a query that has already failed
+        for future in futures:
+            future.cancel()
+        raise
+    return _merge_chunks(frames, dimensions, max_rows)
+
+def _date_chunks(start_date, end_date, days):
+    """Split an inclusive YYYY-MM-DD range into consecutive ranges of at most days days"""
+    start = datetime.date.fromisoformat(start_date)
+    end = datetime.date.fromisoformat(end_date)
+    chunks = []
+    while start <= end:
+        chunk_end = min(start + datetime.timedelta(days=days - 1), end)
+        chunks.append((start.isoformat(), chunk_end.isoformat()))
+        start = chunk_end + datetime.timedelta(days=1)
+    return chunks
+
+def _merge_chunks(frames, dimensions, max_rows=None):
+    """
+    Merge the results of one query over consecutive date ranges.
+    
+    Clicks and impressions are summed per combination of dimensions, CTR is
+    recomputed from the sums and position is averaged weighted by impressions,
+    which is how the API aggregates a range itself. Rows are ordered by clicks
+    like the API's and cut to max_rows.
+    """
+    with _span('merge'):
+        frames = [df for df in frames if not df.empty]
+        if not frames:
+            return _response_to_dataframe({}, dimensions)
+        
+        columns = {dim: pd.api.types.union_categoricals([df[dim] for df in frames]) for dim in dimensions or []}
+        for metric in ['clicks', 'impressions']:
+            columns[metric] = np.concatenate([df[metric].to_numpy() for df in frames])
+        columns['weighted_position'] = np.concatenate(
+            [(df['position'] * df['impressions']).to_numpy() for df in frames])
+        df = pd.DataFrame(columns)
+        
+        if dimensions:
+            df = df.groupby(dimensions, observed=True, sort=False, dropna=False).sum().reset_index()
+        else:
+            df = df.sum().to_frame().T
+        
+        # Recompute the ratios from the summed totals
+        clicks = df['clicks'].to_numpy()
+        impressions = df['impressions'].to_numpy()
+        weighted_position = df.pop('weighted_position').to_numpy()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            df['ctr'] = np.where(impressions > 0, clicks / impressions, 0.0)
+            df['position'] = np.where(impressions > 0, weighted_position / impressions, 0.0)
+        
+        df = df.sort_values('clicks', ascending=False, kind='stable')
+        if max_rows is not None:
+            df = df.head(max_rows)
+        return df.reset_index(drop=True)
+
+def _merge_periods(period_dfs, dimensions):
+    """
+    Outer-join the periods' rows on their dimensions, suffixing metric columns with the period label.
+    
+    The join runs on integer codes rather than strings. Each dimension's
+    categories are combined once across periods and every row gets a single
+    int64 key built from its codes, so a URL or query is hashed once per
+    period instead of once per row. The merged dimension columns are
+    categoricals over the combined categories, holding each distinct value once.
+    """
+    frames = list(period_dfs.values())
+    key = np.zeros(sum(len(df) for df in frames), dtype=np.int64)
+    span = 1
+    dimension_codes = []
+    for dim in dimensions:
+        values = [df[dim].astype('category').cat for df in frames]
+        categories = pd.Index(np.concatenate(
+            [v.categories.to_numpy(dtype=object) for v in values] + [np.array([], dtype=object)])).unique()
+        # Map each period's codes onto the combined categories; -1 (null) stays -1
+        codes = np.concatenate([
+            np.append(categories.get_indexer(v.categories), -1)[v.codes] for v in values
+        ] + [np.array([], dtype=np.intp)])
+        
+        # Nulls take code 0 in the key; renumber the keys first if another dimension would overflow them
+        radix = len(categories) + 1
+        if span * radix >= 2 ** 62:
+            key, uniques = pd.factorize(key)
+            span = len(uniques)
+        key = key * radix + (codes + 1)
+        span *= radix
+        dimension_codes.append((dim, codes, categories))
+    
+    # Rows are numbered in first-seen order, so current period rows come first
+    rows, uniques = pd.factorize(key)
+    _, first = np.unique(rows, return_index=True)
+    columns = {
+        dim: pd.Categorical.from_codes(codes[first], categories)
+        for dim, codes, categories in dimension_codes
+    }
     
-    rows = response['rows']
-    data = []
+    # Scatter each period's metrics into the merged rows; rows missing from a period stay NaN
+    offset = 0
+    for label, df in period_dfs.items():
+        period_rows = rows[offset:offset + len(df)]
+        offset += len(df)
+        for metric in ['clicks', 'impressions', 'ctr', 'position']:
+            merged = np.full(len(uniques), np.nan)
+            merged[period_rows] = df[metric].to_numpy(dtype=np.float64)
+            columns[f'{metric}_{label}'] = merged
+    return pd.DataFrame(columns)
+
+def _response_to_dataframe(response, dimensions):
+    """
+    Decode an API response's rows straight into typed columns.
     
-    for row in rows:
-        row_data = {}
+    Dimensions become categoricals and metrics float64 arrays, without building
+    an intermediate dict per row. Rows with fewer keys than dimensions get nulls.
+    """
+    with _span('decode'):
+        rows = response.get('rows') or []
+        columns = {}
         
-        # Add dimension values
+        # Add dimension values, transposing the keys of every row at once
         if dimensions:
+            keys = list(itertools.zip_longest(*(row.get('keys', ()) for row in rows)))
             for i, dim in enumerate(dimensions):
-                if i < len(row.get('keys', [])):
-                    row_data[dim] = row['keys'][i]
-                else:
-                    row_data[dim] = None
+                values = np.array(keys[i] if i < len(keys) else [None] * len(rows), dtype=object)
+                # factorize keeps first-seen order, which is much cheaper than sorting categories
+                codes, categories = pd.factorize(values)
+                columns[dim] = pd.Categorical.from_codes(codes, categories)
         
         # Add metric values
-        row_data['clicks'] = row.get('clicks', 0)
-        row_data['impressions'] = row.get('impressions', 0)
-        row_data['ctr'] = row.get('ctr', 0)
-        row_data['position'] = row.get('position', 0)
+        for metric in ['clicks', 'impressions', 'ctr', 'position']:
+            columns[metric] = np.fromiter(
+                (row.get(metric, 0) for row in rows), dtype=np.float64, count=len(rows))
         
-        data.append(row_data)
+        return pd.DataFrame(columns)
+
+def _render_output(df, output_format, table, max_bytes=None, totals=None):
+    """
+    Render a tool's result in the requested output format.
+    
+    table is called for the table format and returns the tool's text layout as
+    (header lines, row lines), with one row line per row of df. Output longer
+    than max_bytes is cut at a row boundary and ends with a summary footer
+    giving the rows omitted and totals over every row, or the given totals.
+    df may be None for the table format when totals are given.
+    """
+    if max_bytes is None:
+        max_bytes = OUTPUT_MAX_BYTES
+    
+    with _span('format'):
+        if output_format == 'table':
+            header_lines, row_lines = table()
+        else:
+            columns = [str(column) for column in df.columns]
+            values = [_plain_values(df[column]) for column in df.columns]
+            if output_format == 'csv':
+                header_lines = _csv_lines([columns])
+                row_lines = _csv_lines(zip(*values))
+            elif output_format == 'jsonl':
+                header_lines = []
+                row_lines = [json.dumps(dict(zip(columns, row)), ensure_ascii=False) for row in zip(*values)]
+            else:
+                return _render_columnar_json(df, columns, values, max_bytes, totals)
+        
+        # Keep as many whole rows as fit, leaving room for the header and footer
+        rows = kept = len(row_lines)
+        if max_bytes:
+            sizes = [len(line.encode('utf-8')) + 1 for line in row_lines]
+            used = sum(len(line.encode('utf-8')) + 1 for line in header_lines)
+            if used + sum(sizes) > max_bytes:
+                totals = _result_totals(df) if totals is None else totals
+                footer_size = lambda kept: len(_truncation_footer(rows, output_format, kept, max_bytes, totals).encode('utf-8'))
+                cumulative = list(itertools.accumulate(sizes))
+                kept = bisect.bisect_right(cumulative, max_bytes - used - footer_size(0))
+        
+                # The footer's length depends on the number of rows kept
+                while kept and used + cumulative[kept - 1] + footer_size(kept) > max_bytes:
+                    kept -= 1
+        
+        lines = header_lines + row_lines[:kept]
+        if kept < len(row_lines):
+            lines.append(_truncation_footer(rows, output_format, kept, max_bytes, totals))
+        return "\n".join(lines)
+
+def _render_columnar_json(df, columns, values, max_bytes, totals=None):
+    """Render columns as a JSON object of arrays, cut at a row boundary to fit max_bytes"""
+    cells = [[json.dumps(value, ensure_ascii=False) for value in column] for column in values]
+    
+    def render(kept, summary=None):
+        body = ", ".join(f"{json.dumps(name)}: [{', '.join(column[:kept])}]" for name, column in zip(columns, cells))
+        document = f'{{"columns": {{{body}}}'
+        if summary:
+            document += f', "summary": {json.dumps(summary)}'
+        return document + '}'
+    
+    kept = len(df)
+    if max_bytes and kept:
+        # Each row adds a cell and a separator to every column's array
+        sizes = np.zeros(kept, dtype=np.int64)
+        for column in cells:
+            sizes += np.fromiter((len(cell.encode('utf-8')) + 2 for cell in column), dtype=np.int64, count=kept)
+        if len(render(0).encode('utf-8')) + sizes.sum() > max_bytes:
+            totals = _result_totals(df) if totals is None else totals
+            fixed_size = lambda kept: len(render(0, _truncation_summary(len(df), kept, totals)).encode('utf-8'))
+            cumulative = np.cumsum(sizes)
+            kept = int(np.searchsorted(cumulative, max_bytes - fixed_size(0), side='right'))
+            
+            # The summary's length depends on the number of rows kept
+            while kept and fixed_size(kept) + cumulative[kept - 1] > max_bytes:
+                kept -= 1
+            return render(kept, _truncation_summary(len(df), kept, totals))
+    
+    return render(kept)
+
+def _plain_values(series):
+    """Convert a result column to JSON- and CSV-friendly Python values"""
+    if pd.api.types.is_datetime64_any_dtype(series):
+        series = series.dt.strftime('%Y-%m-%d')
+    elif pd.api.types.is_float_dtype(series):
+        values = series.to_numpy()
+        present = ~np.isnan(values)
+        if np.isfinite(values[present]).all() and (values[present] == np.round(values[present])).all():
+            # Counts come back from the API as floats
+            if present.all():
+                return values.astype(np.int64).tolist()
+            return [int(value) if ok else None for value, ok in zip(values.tolist(), present.tolist())]
+        series = series.round(4)
+    return series.astype(object).where(series.notna(), None).tolist()
+
+def _csv_lines(rows):
+    """Format rows as CSV lines without line terminators"""
+    lines = []
+    csv.writer(_LineSink(lines), lineterminator='').writerows(rows)
+    return lines
+
+class _LineSink:
+    """File-like object that collects each write as a separate string"""
+    
+    def __init__(self, lines):
+        self.write = lines.append
+
+def _result_totals(df):
+    """Total clicks and impressions over a result, with CTR and impression-weighted position"""
+    totals = {}
+    for column in df.columns:
+        column = str(column)
+        suffix = column[len('clicks'):]
+        if not column.startswith('clicks') or 'change' in column or f'impressions{suffix}' not in df:
+            continue
+        clicks = float(df[column].sum())
+        impressions = float(df[f'impressions{suffix}'].sum())
+        position = 0.0
+        if impressions and f'position{suffix}' in df:
+            position = float((df[f'position{suffix}'] * df[f'impressions{suffix}']).sum() / impressions)
+        totals[suffix.lstrip('_')] = {
+            'clicks': int(round(clicks)),
+            'impressions': int(round(impressions)),
+            'ctr': round(clicks / impressions, 4) if impressions else 0.0,
+            'position': round(position, 2)
+        }
+    
+    # A single set of metrics needs no label
+    if list(totals) == ['']:
+        return totals['']
+    return totals
+
+def _truncation_summary(rows, kept, totals):
+    """Describe the rows left out of a truncated result of rows rows"""
+    return {
+        'rows': rows,
+        'rows_returned': kept,
+        'rows_omitted': rows - kept,
+        'totals': totals
+    }
+
+def _truncation_footer(rows, output_format, kept, max_bytes, totals):
+    """Format the footer line of a truncated result of rows rows"""
+    summary = _truncation_summary(rows, kept, totals)
+    if output_format == 'jsonl':
+        return json.dumps({'summary': summary})
+    
+    totals = summary['totals']
+    groups = totals.items() if totals and 'clicks' not in totals else [('', totals)]
+    described = "; ".join(
+        (f"{label}: " if label else "") +
+        f"clicks {metrics['clicks']}, impressions {metrics['impressions']}, "
+        f"CTR {metrics['ctr'] * 100:.2f}%, position {metrics['position']:.2f}"
+        for label, metrics in groups if metrics
+    )
+    footer = (f"... output truncated to {kept} of {rows} rows ({rows - kept} rows omitted) "
+              f"to stay under {max_bytes} bytes.")
+    if described:
+        footer += f" Totals over all rows: {described}"
+    return footer if output_format == 'table' else f"# {footer}"
+
+def _format_column(values, spec):
+    """
+    Format a whole numeric column with a fixed-point str.format spec such as '{:.2f}%'.
+    
+    Values are grouped by their rounded value and each distinct value is
+    formatted once, so the cost depends on the number of distinct displayed
+    values rather than on the number of rows.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    
+    # Short columns are cheaper to format directly than to group
+    if len(values) < 10000:
+        return list(map(spec.format, values.tolist()))
+    
+    scale = 10 ** int(re.search(r'\.(\d+)f', spec).group(1))
+    scaled = values * scale
+    rounded = np.rint(scaled)
     
-    return pd.DataFrame(data)
+    # Values within float error of a rounding tie (and inf, nan and -0) are formatted one by one
+    with np.errstate(invalid='ignore'):
+        exact = ~np.isfinite(scaled) | (np.abs(np.abs(scaled) % 1 - 0.5) < 1e-6) | ((rounded == 0) & np.signbit(values))
+    
+    codes, uniques = pd.factorize(rounded)
+    formatted = np.array([spec.format(value / scale) for value in uniques] + [''], dtype=object)
+    result = formatted[codes]
+    if exact.any():
+        result[exact] = [spec.format(value) for value in values[exact]]
+    return result.tolist()
+
+def _format_text(values):
+    """Format a column as strings, converting each distinct categorical value only once"""
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        categories = np.append(values.cat.categories.astype(str).to_numpy(dtype=object), 'None')
+        return categories[values.cat.codes.to_numpy()].tolist()
+    return values.astype(str).tolist()
+
+def _join_columns(columns, separator=" | "):
+    """Join formatted columns into table lines"""
+    return list(map(separator.join, zip(*columns)))
+
+def _start_warmer():
+    """Start the cache warmer, logging instead of failing if its config is invalid"""
+    try:
+        _warmer.load_config()
+    except (OSError, ValueError) as e:
+        logger.error("Cache warmer not started; invalid GSC_WARM_CONFIG %s: %s", WARM_CONFIG, e)
+        return
+    _warmer.start()
+
+def _http_app():
+    """Build the streamable HTTP app of a worker process"""
+    # Any worker may receive any request, so no session state is kept between requests
+    mcp.settings.stateless_http = True
+    app = mcp.streamable_http_app()
+    
+    # Close the stores after the worker has stopped serving requests
+    serve = app.router.lifespan_context
+    
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        async with serve(app):
+            if WARM_CONFIG:
+                _start_warmer()
+            yield
+            _warmer.stop()
+        for store in (_cache, _warehouse, _rollups, _scheduler.buckets):
+            store.close()
+    
+    app.router.lifespan_context = lifespan
+    return app
+
+def _serve_http():
+    """
+    Serve the streamable HTTP transport from GSC_HTTP_WORKERS processes on one port.
+    
+    The workers share the response cache, local store and rollup cube on disk,
+    so data fetched by one is served by the others. On SIGTERM or SIGINT each
+    worker stops accepting requests and lets running ones finish for up to
+    GSC_HTTP_SHUTDOWN_TIMEOUT seconds before cancelling them.
+    """
+    import uvicorn
+    
+    options = {
+        'host': HTTP_HOST,
+        'port': HTTP_PORT,
+        'limit_concurrency': HTTP_MAX_REQUESTS or None,
+        'timeout_graceful_shutdown': HTTP_SHUTDOWN_TIMEOUT,
+    }
+    if HTTP_WORKERS > 1:
+        # Each worker imports this module and builds its own app
+        module = os.path.splitext(os.path.basename(__file__))[0]
+        uvicorn.run(f'{module}:_http_app', factory=True, workers=HTTP_WORKERS,
+                    app_dir=os.path.dirname(os.path.abspath(__file__)), **options)
+    else:
+        uvicorn.run(_http_app(), **options)
 
 if __name__ == "__main__":
-    mcp.run()
\ No newline at end of file
+    if TRANSPORT not in TRANSPORTS:
+        raise SystemExit(f"Invalid GSC_TRANSPORT: {TRANSPORT}. Valid transports are: {', '.join(TRANSPORTS)}")
+    
+    # Metrics are per process, so the endpoint is only served by a single server process
+    if METRICS_PORT and SERVER_PROCESSES > 1:
+        logger.warning("GSC_METRICS_PORT is ignored with more than one HTTP worker")
+    elif METRICS_PORT:
+        _serve_metrics(METRICS_PORT)
+    
+    if TRANSPORT == 'streamable-http':
+        _serve_http()
+    else:
+        if WARM_CONFIG:
+            _start_warmer()
+        mcp.run()
\ No newline at end of file